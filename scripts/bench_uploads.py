@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Event loop latency while files are uploaded.
+
+Writes several files concurrently, either with blocking writes on the event
+loop or with `tozti.store.blobs.LocalStorage`, and measures how late a
+timer firing every 10ms is woken up.
+
+Usage: ``python scripts/bench_uploads.py [-c CONCURRENCY] [-s SIZE_MB] [DIR]``
+"""
+
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from tozti.store.blobs import LocalStorage
+
+
+CHUNK = b'x' * 65536
+
+
+class Stream:
+    """Minimal `StreamReader` yielding `size` bytes."""
+
+    def __init__(self, size):
+        self.left = size
+
+    async def read(self, n):
+        await asyncio.sleep(0)
+        n = min(n, self.left, len(CHUNK))
+        self.left -= n
+        return CHUNK[:n]
+
+
+async def blocking_write(stream, directory, i, fsync):
+    with open(os.path.join(directory, str(i)), 'wb') as file:
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            file.write(chunk)
+        if fsync != 'never':
+            file.flush()
+            os.fsync(file.fileno())
+
+
+async def storage_write(stream, directory, i, fsync):
+    await LocalStorage(directory, fsync=fsync).write(stream)
+
+
+async def measure(write, directory, concurrency, size, fsync):
+    lags = []
+    done = False
+
+    async def ticker():
+        while not done:
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            lags.append(time.monotonic() - start - 0.01)
+
+    task = asyncio.ensure_future(ticker())
+    start = time.monotonic()
+    await asyncio.gather(*[
+        write(Stream(size), directory, i, fsync=fsync)
+        for i in range(concurrency)])
+    elapsed = time.monotonic() - start
+    done = True
+    await task
+    lags.sort()
+    return elapsed, lags[len(lags) // 2], lags[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser('bench_uploads')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='number of files written at once (default: 4)')
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='size of each file in MB (default: 256)')
+    parser.add_argument('-f', '--fsync', default='file',
+                        help='fsync policy (default: file)')
+    parser.add_argument('directory', nargs='?', default=None,
+                        help='where to write (default: a temporary directory)')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        for (name, write) in (('blocking', blocking_write),
+                              ('LocalStorage', storage_write)):
+            elapsed, median, worst = loop.run_until_complete(measure(
+                write, directory, args.concurrency, args.size << 20,
+                args.fsync))
+            print('{:<14} {:6.2f}s  loop lag median: {:7.2f}ms  max: {:7.2f}ms'
+                  .format(name, elapsed, median * 1e3, worst * 1e3))
+
+
+if __name__ == '__main__':
+    main()
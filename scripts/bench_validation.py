@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Microbenchmark of the store validation path.
+
+Compares `tozti.utils.validate` (schema checked and validator built on every
+call) with the validators built once by `tozti.utils.compile_validator`.
+
+Usage: ``python scripts/bench_validation.py [-n NUMBER]``
+"""
+
+
+import argparse
+import timeit
+from uuid import uuid4
+
+from tozti.core_schemas import user_schema
+from tozti.store.schema import Schema, RelationshipModel
+from tozti.utils import validate, compile_validator
+
+
+def cases():
+    user = {'data': {'type': 'core/user', 'body': {
+        'name': 'John', 'email': 'john@example.com', 'handle': 'john',
+        'hash': 'x' * 100, 'groups': {'data': []}, 'pinned': {'data': []}}}}
+    children = {'data': [{'id': str(uuid4()), 'type': 'core/folder'}
+                         for _ in range(500)]}
+
+    yield 'Schema.SCHEMA', Schema.SCHEMA, user
+    yield 'core/user.email', user_schema['body']['email'], 'john@example.com'
+    yield 'TO_MANY_SCHEMA (500 linkages)', RelationshipModel.TO_MANY_SCHEMA, children
+
+
+def main():
+    parser = argparse.ArgumentParser('bench_validation')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='number of validations per case (default: 2000)')
+    args = parser.parse_args()
+
+    for (name, schema, inst) in cases():
+        compiled = compile_validator(schema)
+        n = args.number if 'linkages' not in name else max(args.number // 100, 1)
+        old = timeit.timeit(lambda: validate(inst, schema), number=n)
+        new = timeit.timeit(lambda: compiled(inst), number=n)
+        print('{:<32} validate: {:8.2f}us  compiled: {:8.2f}us  x{:.1f}'.format(
+            name, old / n * 1e6, new / n * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
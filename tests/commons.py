@@ -59,19 +59,23 @@ def tozti_still_running(tozti):
 
 API = 'http://localhost:8080/api'
 
-def make_call(meth, path, json=None, content_type='application/vnd.api+json', cookies=None):
+def make_call(meth, path, json=None, content_type='application/vnd.api+json', cookies=None, headers=None):
     """make a call to the storage API
 
     Params:
         meth: the method use by the call. ex: PATCH, PUT, GET, POST, DELETE
         path: the relative path to the api
         json: the json that must be send with the request
+        headers: additional headers to send with the request
 
     Returns:
         a `requests` object
     """
+    all_headers = { 'content-type': content_type }
+    if headers is not None:
+        all_headers.update(headers)
     return requests.request(meth, API + path, json=json,
-            headers = { 'content-type': content_type },
+            headers = all_headers,
             cookies = cookies)
 
 def db_contains_object(db, obj):
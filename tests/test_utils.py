@@ -0,0 +1,94 @@
+import pytest
+from datetime import datetime
+
+from tozti.utils import (validate, compile_validator, ValidationError,
+                         etag_matches, http_date, parse_http_date, parse_range)
+
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'email': {'type': 'string', 'format': 'email'},
+    },
+    'required': ['name'],
+}
+
+
+@pytest.mark.parametrize("inst", [
+    {'name': 'foo'},
+    {'name': 'foo', 'email': 'foo@bar.baz'},
+    ])
+def test_compile_validator_valid(inst):
+    """Test that compiled validators accept valid data"""
+    compile_validator(SCHEMA)(inst)
+
+
+@pytest.mark.parametrize("inst", [
+    {},
+    {'name': 42},
+    {'name': 'foo', 'email': 'not an email'},
+    [],
+    ])
+def test_compile_validator_same_errors(inst):
+    """Test that compiled validators raise the same errors as `validate`"""
+    with pytest.raises(ValidationError) as expected:
+        validate(inst, SCHEMA)
+    with pytest.raises(ValidationError) as got:
+        compile_validator(SCHEMA)(inst)
+    assert got.value.message == expected.value.message
+
+
+def test_compile_validator_bad_schema():
+    """Test that invalid schemas are rejected at compile time"""
+    with pytest.raises(Exception):
+        compile_validator({'type': 42})
+
+
+def test_etag_matches():
+    assert etag_matches('"1", "2"', '"2"')
+    assert etag_matches('*', '"2"')
+    assert etag_matches('W/"2"', '"2"')
+    assert not etag_matches('W/"2"', '"2"', weak=False)
+    assert not etag_matches('"1"', '"2"')
+
+
+def test_http_date():
+    date = datetime(2018, 2, 5, 23, 13, 26)
+    assert http_date(date) == 'Mon, 05 Feb 2018 23:13:26 GMT'
+    assert parse_http_date(http_date(date)) == date
+    assert parse_http_date('garbage') is None
+
+
+class FakeRequest:
+    def __init__(self, **headers):
+        self.headers = {k.replace('_', '-'): v for (k, v) in headers.items()}
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('bytes=0-9', (0, 10)),
+    ('bytes=90-', (90, 100)),
+    ('bytes=90-200', (90, 100)),
+    ('bytes=-10', (90, 100)),
+    ('bytes=-200', (0, 100)),
+    ('bytes=5-1', None),
+    ('bytes=0-1,5-6', None),
+    ('lines=0-1', None),
+    ('bytes=a-b', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(FakeRequest(Range=header), 100) == expected
+
+
+def test_parse_range_unsatisfiable():
+    with pytest.raises(ValueError):
+        parse_range(FakeRequest(Range='bytes=100-'), 100)
+    with pytest.raises(ValueError):
+        parse_range(FakeRequest(Range='bytes=-0'), 100)
+
+
+def test_parse_range_if_range():
+    assert parse_range(FakeRequest(), 100) is None
+    req = FakeRequest(Range='bytes=0-9', If_Range='"a"')
+    assert parse_range(req, 100, '"a"') == (0, 10)
+    assert parse_range(req, 100, '"b"') is None
@@ -0,0 +1,83 @@
+from tozti.store.cache import ResourceCache
+
+
+def test_cache_hit_miss():
+    cache = ResourceCache(size=2, ttl=0)
+    assert cache.get(1) is None
+    cache.put(1, {'_id': 1}, cache.generation)
+    assert cache.get(1) == {'_id': 1}
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_cache_lru_eviction():
+    cache = ResourceCache(size=2, ttl=0)
+    for i in range(2):
+        cache.put(i, {'_id': i}, cache.generation)
+    cache.get(0)
+    cache.put(2, {'_id': 2}, cache.generation)
+    assert cache.get(1) is None
+    assert cache.get(0) is not None
+    assert cache.evictions == 1
+
+
+def test_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('tozti.store.cache.monotonic', lambda: now[0])
+    cache = ResourceCache(size=2, ttl=10)
+    cache.put(1, {'_id': 1}, cache.generation)
+    now[0] += 11
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_cache_invalidate_during_read():
+    """A document read before an invalidation must not be cached"""
+    cache = ResourceCache(size=2, ttl=0)
+    generation = cache.generation
+    cache.invalidate(1)
+    cache.put(1, {'_id': 1}, generation)
+    assert cache.get(1) is None
+
+
+def test_cache_disabled():
+    cache = ResourceCache(size=0)
+    cache.put(1, {'_id': 1}, cache.generation)
+    assert cache.get(1) is None
+
+
+def test_type_cache():
+    from uuid import uuid4
+    from tozti.store.cache import TypeCache
+    cache = TypeCache(size=2)
+    ids = [uuid4() for _ in range(3)]
+    for id in ids:
+        cache.put(id, 'core/user', cache.generation)
+    assert cache.get(ids[0]) is None
+    assert cache.get(ids[2]) == 'core/user'
+    cache.discard(ids[2])
+    assert cache.get(ids[2]) is None
+    assert len(cache) == 1
+
+
+def test_type_cache_discard_during_read():
+    """A resource deleted while its type is read must not be cached"""
+    from uuid import uuid4
+    from tozti.store.cache import TypeCache
+    cache = TypeCache()
+    id = uuid4()
+    generation = cache.generation
+    cache.discard(id)
+    cache.put(id, 'core/user', generation)
+    assert cache.get(id) is None
+
+
+def test_cache_default_and_entry_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('tozti.store.cache.monotonic', lambda: now[0])
+    missing = object()
+    cache = ResourceCache(size=10, ttl=60)
+    assert cache.get('h', missing) is missing
+    cache.put('h', None, cache.generation, ttl=5)
+    assert cache.get('h', missing) is None
+    now[0] += 6
+    assert cache.get('h', missing) is missing
@@ -0,0 +1,53 @@
+import pytest
+from uuid import uuid4
+
+from tozti.store import BadQueryError
+from tozti.store.schema import Schema
+
+
+SCHEMA = {'body': {
+    'name': {'type': 'string'},
+    'age': {'type': 'integer'},
+    'tags': {'type': 'array', 'items': {'type': 'string'}},
+    'friends': {'type': 'relationship', 'arity': 'to-many'},
+}}
+
+
+def test_filter_query():
+    schema = Schema('foo', SCHEMA, db=None)
+    id = uuid4()
+    query = schema.filter_query({
+        'name': {'eq': 'john'},
+        'age': {'gte': '18', 'lt': 65},
+        'tags': {'contains': 'a'},
+        'friends': {'contains': str(id)}})
+    assert query == {'type': 'foo',
+                     'body.name': {'$eq': 'john'},
+                     'body.age': {'$gte': 18, '$lt': 65},
+                     'body.tags': {'$eq': 'a'},
+                     'body.friends.id': {'$eq': id}}
+
+
+def test_filter_query_in():
+    schema = Schema('foo', SCHEMA, db=None)
+    assert schema.filter_query({'age': {'in': '1,2'}}) == {
+        'type': 'foo', 'body.age': {'$in': [1, 2]}}
+
+
+@pytest.mark.parametrize('filters', [
+    {'nope': {'eq': 'a'}},
+    {'name': {'like': 'a'}},
+    {'age': {'eq': 'a'}},
+    {'tags': {'eq': 'a'}},
+    {'friends': {'eq': 'a'}},
+    {'friends': {'contains': 'a'}},
+])
+def test_filter_query_invalid(filters):
+    schema = Schema('foo', SCHEMA, db=None)
+    with pytest.raises(BadQueryError):
+        schema.filter_query(filters)
+
+
+def test_relationship_indexes():
+    schema = Schema('foo', SCHEMA, db=None)
+    assert [('type', 1), ('body.friends.id', 1)] in list(schema.indexes())
@@ -0,0 +1,220 @@
+import asyncio
+import copy
+from datetime import datetime
+from unittest.mock import Mock
+from uuid import uuid4
+
+import tozti
+from tozti.store.engine import Store
+from tozti.store.loader import (ResourceLoader, current_loader, spawn,
+                                run_concurrently, _current_task, _LOADERS)
+
+
+class FakeStore:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+        self.projections = []
+
+    async def _resources_by_id(self, ids, projection=None):
+        self.queries.append(set(ids))
+        self.projections.append(projection)
+        docs = {id: self.docs[id] for id in ids if id in self.docs}
+        await asyncio.sleep(0)
+        return docs
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_batch():
+    store = FakeStore({1: 'a', 2: 'b', 3: 'c'})
+    loader = ResourceLoader(store)
+
+    async def main():
+        return await asyncio.gather(loader.load(1), loader.load(2),
+                                    loader.load_many([2, 3, 4]))
+
+    assert run(main()) == ['a', 'b', {2: 'b', 3: 'c'}]
+    assert store.queries == [{1, 2, 3, 4}]
+
+
+def test_identity_map():
+    store = FakeStore({1: 'a'})
+    loader = ResourceLoader(store)
+    assert run(loader.load(1)) == 'a'
+    assert run(loader.load(2)) is None
+    assert run(loader.load_many([1, 2])) == {1: 'a'}
+    assert store.queries == [{1}, {2}]
+
+    store.docs[1] = 'b'
+    loader.forget(1)
+    assert run(loader.load(1)) == 'b'
+    assert store.queries == [{1}, {2}, {1}]
+
+
+def test_projection():
+    store = FakeStore({1: 'a', 2: 'b'})
+    loader = ResourceLoader(store)
+
+    async def main():
+        return await asyncio.gather(loader.load(1, {'type': 1}),
+                                    loader.load(2, {'type': 1}),
+                                    loader.load(2))
+
+    assert run(main()) == ['a', 'b', 'b']
+    assert store.queries == [{1, 2}, {2}]
+    assert store.projections == [{'type': 1}, None]
+    # whole documents answer the lookups with a projection
+    assert run(loader.load(2, {'type': 1, 'version': 1})) == 'b'
+    assert len(store.queries) == 2
+
+
+def test_forget_while_loading():
+    store = FakeStore({1: 'a'})
+    loader = ResourceLoader(store)
+
+    async def main():
+        before = asyncio.ensure_future(loader.load(1))
+        while not store.queries:
+            await asyncio.sleep(0)
+        store.docs[1] = 'b'
+        loader.forget(1)
+        return (await before, await loader.load(1))
+
+    assert run(main()) == ('a', 'b')
+    assert run(loader.load(1)) == 'b'
+    assert store.queries == [{1}, {1}]
+
+
+def test_size():
+    store = FakeStore({1: 'a', 2: 'b', 3: 'c'})
+    loader = ResourceLoader(store, size=2)
+    for id in (1, 2, 3, 1):
+        run(loader.load(id))
+    assert store.queries == [{1}, {2}, {3}, {1}]
+
+
+def test_spawn():
+    loader = ResourceLoader(FakeStore({}))
+
+    async def inner():
+        return current_loader()
+
+    async def main():
+        _LOADERS[_current_task()] = loader
+        return (await spawn(inner()),
+                await run_concurrently([inner(), inner()]),
+                await asyncio.ensure_future(inner()))
+
+    assert run(main()) == (loader, [loader, loader], None)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def project(doc, projection):
+    if projection is None:
+        return copy.deepcopy(doc)
+    res = {'_id': doc['_id']}
+    for path in projection:
+        (src, dst) = (doc, res)
+        keys = path.split('.')
+        for key in keys[:-1]:
+            if key not in src:
+                break
+            (src, dst) = (src[key], dst.setdefault(key, {}))
+        else:
+            if keys[-1] in src:
+                dst[keys[-1]] = copy.deepcopy(src[keys[-1]])
+    return res
+
+
+class FakeResources:
+    """Stands for the `resources` collection, with the few queries used to
+    read and update relationships."""
+
+    def __init__(self, docs):
+        self.docs = {doc['_id']: doc for doc in docs}
+
+    def find(self, query, projection=None):
+        ids = query['_id']['$in']
+        return FakeCursor([project(self.docs[id], projection)
+                           for id in ids if id in self.docs])
+
+    async def find_one_and_update(self, query, update, projection=None,
+                                  return_document=None):
+        doc = self.docs[query['_id']]
+        for (path, value) in update['$set'].items():
+            if path.startswith('body.'):
+                doc['body'][path[5:]] = value
+        return project(doc, projection)
+
+    async def update_many(self, query, update):
+        for id in query['_id']['$in']:
+            doc = self.docs[id]
+            if '$addToSet' in update:
+                for (path, value) in update['$addToSet'].items():
+                    links = doc['body'].setdefault(path.split('.')[1], [])
+                    if value not in links:
+                        links.append(value)
+            if '$pull' in update:
+                for (path, value) in update['$pull'].items():
+                    key = path.split('.')[1]
+                    doc['body'][key] = [l for l in doc['body'].get(key, [])
+                                        if l['id'] != value['id']]
+
+
+def test_store_relationship(monkeypatch, tmpdir):
+    monkeypatch.setattr(tozti, 'CONFIG', {'http': {
+        'hostname': 'localhost', 'upload_dir': str(tmpdir)}}, raising=False)
+    types = {
+        'foo': {'body': {'member': {'type': 'relationship', 'arity': 'to-one',
+                                    'targets': 'bar'}}},
+        'bar': {'body': {'owners': {'type': 'relationship', 'arity': 'auto',
+                                    'pred-type': 'foo',
+                                    'pred-relationship': 'member'}}},
+    }
+    store = Store(types, {'materialize_auto': True})
+    (foo, bar, baz) = (uuid4(), uuid4(), uuid4())
+    now = datetime.utcnow()
+    store._db = Mock(resources=FakeResources([
+        {'_id': foo, 'type': 'foo', 'body': {'member': {'id': bar, 'type': 'bar'}},
+         'created': now, 'last-modified': now},
+        {'_id': bar, 'type': 'bar', 'body': {'owners': [{'id': foo, 'type': 'foo'}]},
+         'created': now, 'last-modified': now},
+        {'_id': baz, 'type': 'bar', 'body': {'owners': []},
+         'created': now, 'last-modified': now},
+    ]))
+
+    async def in_request(coro):
+        # as done by `loader_middleware`
+        _LOADERS[_current_task()] = store.request_loader()
+        return await coro
+
+    # projections without the type go through the loader
+    res = run(in_request(store.item_read(foo, 'member')))
+    assert res['data']['id'] == bar
+    run(in_request(store.item_update(
+        foo, 'member', {'data': {'id': str(baz)}}, render=False)))
+    docs = store._db.resources.docs
+    assert docs[foo]['body']['member'] == {'id': baz, 'type': 'bar'}
+    assert docs[bar]['body']['owners'] == []
+    assert docs[baz]['body']['owners'] == [{'id': foo, 'type': 'foo'}]
@@ -67,3 +67,22 @@ def test_storage_rel_tomany_get_empty(tozti, db):
     uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": []}}})
     result = make_call("GET", "/store/resources/{}/members".format(uid_foo))
     assert len(result.json()["data"]["data"]) == 0
+
+@pytest.mark.extensions("rel02")
+def test_storage_rel_tomany_get_include(tozti, db):
+    uid_bar = add_object_get_id({"type": "rel02/bar", "body": {"bar": "bar"}})
+    uid_bar2 = add_object_get_id({"type": "rel02/bar", "body": {"bar": "baz"}})
+    uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": [{"id": uid_bar}, {"id": uid_bar2}, {"id": uid_bar}]}}})
+
+    result = make_call("GET", "/store/resources/{}?include=members".format(uid_foo)).json()
+    assert result["data"]["id"] == uid_foo
+    assert sorted(x["id"] for x in result["included"]) == sorted([uid_bar, uid_bar2])
+
+    result = make_call("GET", "/store/resources/{}/members?include=members".format(uid_foo)).json()
+    assert sorted(x["id"] for x in result["included"]) == sorted([uid_bar, uid_bar2])
+
+@pytest.mark.extensions("rel02")
+def test_storage_rel_get_include_bad_path(tozti, db):
+    uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": []}}})
+    assert make_call("GET", "/store/resources/{}?include=members..".format(uid_foo)).status_code == 400
+    assert make_call("GET", "/store/resources/{}/members?include=foo".format(uid_foo)).status_code == 400
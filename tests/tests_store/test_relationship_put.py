@@ -32,6 +32,17 @@ def test_storage_rel_tomany_put_valid(tozti, db):
     foo = {"body": {"foo": "foo", "members": [{'id': UUID(uid_bar2), 'type': 'rel02/bar'}]}}
     assert db_contains_object(db, foo)
 
+@pytest.mark.extensions("rel02")
+def test_storage_rel_tomany_put_missing_target(tozti, db):
+    uid_bar = add_object_get_id({"type": "rel02/bar", "body": {"bar": "bar"}})
+    uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": [{"id": uid_bar}]}}})
+
+    result = make_call("PUT", "/store/resources/{}/members".format(uid_foo), json={"data": [{'id': uid_bar}, {'id': str(uuid4())}]})
+    assert result.status_code == 400
+
+    foo = {"body": {"foo": "foo", "members": [{'id': UUID(uid_bar), 'type': 'rel02/bar'}]}}
+    assert db_contains_object(db, foo)
+
 @pytest.mark.extensions("rel02")
 def test_storage_rel_tomany_put_incorrect_format(tozti, db):
     uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": []}}})
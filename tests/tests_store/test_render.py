@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+import tozti
+from tozti.store.schema import Schema
+
+
+SCHEMA = {'body': {
+    'name': {'type': 'string'},
+    'a': {'type': 'relationship', 'arity': 'auto',
+          'pred-type': 'bar', 'pred-relationship': 'a'},
+    'b': {'type': 'relationship', 'arity': 'auto',
+          'pred-type': 'bar', 'pred-relationship': 'b'},
+    'c': {'type': 'relationship', 'arity': 'auto',
+          'pred-type': 'bar', 'pred-relationship': 'c'},
+}}
+
+
+class SlowTargets:
+    """Stands for `RelationshipModel.targets`, counting the queries running
+    at the same time."""
+
+    running = 0
+    max_running = 0
+
+    def __init__(self, id):
+        self._items = None
+        self._id = id
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._items is None:
+            cls = SlowTargets
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+            await asyncio.sleep(0.01)
+            cls.running -= 1
+            self._items = iter([{'id': self._id}])
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+@pytest.mark.parametrize('concurrency', [1, 2, 8])
+def test_render_concurrency(monkeypatch, concurrency):
+    monkeypatch.setattr(tozti, 'CONFIG', {'http': {'hostname': 'localhost'}},
+                        raising=False)
+    schema = Schema('foo', SCHEMA, db=None, concurrency=concurrency)
+    monkeypatch.setattr(SlowTargets, 'max_running', 0)
+    for key in 'abc':
+        monkeypatch.setattr(schema[key], 'targets', SlowTargets)
+
+    id = uuid4()
+    rep = {'_id': id, 'type': 'foo', 'body': {'name': 'x'},
+           'created': datetime.now(), 'last-modified': datetime.now()}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        res = loop.run_until_complete(schema.render(rep))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    assert res['body']['name'] == 'x'
+    for key in 'abc':
+        assert res['body'][key]['data'] == [{'id': id}]
+    assert SlowTargets.max_running == min(concurrency, 3)
@@ -1,4 +1,5 @@
-from tests.commons import db_contains_object, make_call, add_object_get_id
+from tests.commons import db_contains_object, make_call, add_object_get_id, API
+import requests
 import json
 import pytest
 from uuid import UUID, uuid4
@@ -29,3 +30,27 @@ def test_storage_post_request(tozti, db, json, expected):
 def test_storage_post_no_content(tozti, db):
     assert make_call("POST", '/store/resources').status_code == 400
 
+
+@pytest.mark.extensions("type")
+def test_storage_post_bulk(tozti, db):
+    objs = [{"type": TYPE, "body": {"name": "f", "email": "a@a.com"}},
+            {"type": TYPE, "body": {"name": "f", "email": "a"}},
+            {"type": TYPE, "body": {"name": "g", "email": "b@b.com"}}]
+    ret_val = make_call("POST", '/store/resources/bulk', json={"data": objs})
+    assert ret_val.status_code == 200
+    results = ret_val.json()["data"]
+    assert "id" in results[0] and "id" in results[2]
+    assert results[1]["errors"][0]["status"] == "400"
+    assert db.count() == 2
+
+@pytest.mark.extensions("type")
+def test_storage_post_bulk_ndjson(tozti, db):
+    objs = [{"type": TYPE, "body": {"name": str(i), "email": "a@a.com"}} for i in range(10)]
+    body = "\n".join(json.dumps(o) for o in objs) + "\n{bad json\n"
+    ret_val = requests.post(API + '/store/resources/bulk', data=body,
+                            headers={'content-type': 'application/x-ndjson'})
+    assert ret_val.status_code == 200
+    results = ret_val.json()["data"]
+    assert all("id" in res for res in results[:10])
+    assert results[10]["errors"][0]["code"] == "BAD_JSON"
+    assert db.count() == 10
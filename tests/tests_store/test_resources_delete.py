@@ -1,5 +1,6 @@
 from tests.commons import db_contains_object, make_call, add_object_get_id
 import json
+import time
 import pytest
 from uuid import UUID, uuid4
 
@@ -30,3 +31,22 @@ def test_storage_delete_object_fail_uuid(tozti, db):
     assert make_call("DELETE", "/store/resources/00000000-0000-0000-0000-000000000000").status_code == 404
 
 
+
+
+@pytest.mark.extensions("rel02")
+def test_storage_delete_collects_references(tozti, db):
+    uid_bar = add_object_get_id({"type": "rel02/bar", "body": {"bar": "bar"}})
+    uid_bar2 = add_object_get_id({"type": "rel02/bar", "body": {"bar": "bar"}})
+    uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": [{"id": uid_bar}, {"id": uid_bar2}]}}})
+    make_call("POST", "/store/by-handle/bar", json={"data": {"id": uid_bar}})
+
+    make_call("DELETE", "/store/resources/{}".format(uid_bar))
+
+    # references are collected in the background
+    for _ in range(50):
+        members = make_call("GET", "/store/resources/{}/members".format(uid_foo)).json()["data"]["data"]
+        if len(members) == 1:
+            break
+        time.sleep(0.1)
+    assert [x["id"] for x in members] == [uid_bar2]
+    assert make_call("GET", "/store/by-handle/bar").status_code == 404
@@ -28,3 +28,51 @@ def test_storage_get_object_fail_not_uuid(tozti, db):
 def test_storage_get_object_fail_uuid(tozti, db):
     assert make_call("GET", "/store/resources/00000000-0000-0000-0000-000000000000").status_code == 404
 
+
+@pytest.mark.extensions("type")
+def test_storage_fetch_many(tozti, db):
+    uid1 = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    uid2 = add_object_get_id({"type": TYPE, "body": {"name": "g", "email": "a@a.com"}})
+    make_call("POST", "/store/by-handle/foo", json={"data": {"id": uid2}})
+    missing = str(uuid4())
+
+    result = make_call("POST", "/store/fetch", json={"data": [
+        {"id": uid1}, {"id": missing}, {"handle": "foo"}, {"handle": "bar"}]})
+    assert result.status_code == 200
+    data = result.json()["data"]
+    assert data[0]["id"] == uid1 and data[0]["body"]["name"] == "f"
+    assert data[1]["errors"][0]["status"] == "404"
+    assert data[2]["id"] == uid2
+    assert data[3]["errors"][0]["status"] == "404"
+
+
+@pytest.mark.extensions("type")
+def test_storage_get_object_sparse_fields(tozti, db):
+    uid = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    result = make_call("GET", "/store/resources/{}?fields[{}]=name".format(uid, TYPE))
+    assert result.status_code == 200
+    assert result.json()["data"]["body"] == {"name": "f"}
+
+    result = make_call("GET", "/store/by-type/{}?fields[{}]=email".format(TYPE, TYPE))
+    assert [x["body"] for x in result.json()["data"]] == [{"email": "a@a.com"}]
+
+    assert make_call("GET", "/store/resources/{}?fields[{}]=foo".format(uid, TYPE)).status_code == 400
+
+
+@pytest.mark.extensions("type")
+def test_storage_get_object_conditional(tozti, db):
+    uid = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    result = make_call("GET", "/store/resources/{}".format(uid))
+    etag = result.headers["ETag"]
+    assert result.json()["data"]["meta"]["version"] == 1
+
+    result = make_call("GET", "/store/resources/{}".format(uid), headers={"If-None-Match": etag})
+    assert result.status_code == 304
+    result = make_call("GET", "/store/resources/{}".format(uid),
+                       headers={"If-Modified-Since": result.headers["Last-Modified"]})
+    assert result.status_code == 304
+
+    make_call("PATCH", "/store/resources/{}".format(uid), json={"data": {"body": {"name": "g"}}})
+    result = make_call("GET", "/store/resources/{}".format(uid), headers={"If-None-Match": etag})
+    assert result.status_code == 200
+    assert result.headers["ETag"] != etag
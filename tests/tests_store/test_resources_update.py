@@ -33,6 +33,25 @@ def test_storage_update_valid(tozti, db):
     assert db.count() == 1
     assert db_contains_object(db, theory)
 
+@pytest.mark.extensions("type")
+def test_storage_update_returns_resource(tozti, db):
+    uid = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    result = make_call("PATCH", "/store/resources/{}".format(uid),
+                       json={"data": {"body": {"name": "g"}}})
+    assert result.status_code == 200
+    assert result.json()["data"]["body"]["name"] == "g"
+
+@pytest.mark.extensions("type")
+def test_storage_update_return_minimal(tozti, db):
+    uid = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    theory = {"type": TYPE, "body": {"name": "g", "email": "a@a.com"}}
+    result = make_call("PATCH", "/store/resources/{}".format(uid),
+                       json={"data": {"body": {"name": "g"}}},
+                       headers={"Prefer": "return=minimal"})
+    assert result.status_code == 204
+    assert result.headers["Preference-Applied"] == "return=minimal"
+    assert db_contains_object(db, theory)
+
 @pytest.mark.extensions("type")
 def test_storage_update_no_content(tozti, db):
     json = {"type": TYPE, "body": {"name": "f", "email": "a@a.com"}}
@@ -44,3 +63,23 @@ def test_storage_update_object_fail_not_uuid(tozti, db):
 
 def test_storage_update_object_fail_uuid(tozti, db):
     assert make_call("PATCH", "/store/resources/00000000-0000-0000-0000-000000000000").status_code == 400
+
+@pytest.mark.extensions("type")
+def test_storage_update_if_match(tozti, db):
+    uid = add_object_get_id({"type": TYPE, "body": {"name": "f", "email": "a@a.com"}})
+    etag = make_call("GET", "/store/resources/{}".format(uid)).headers["ETag"]
+
+    result = make_call("PATCH", "/store/resources/{}".format(uid),
+                       json={"data": {"body": {"name": "g"}}},
+                       headers={"If-Match": etag})
+    assert result.status_code == 200
+    assert result.headers["ETag"] != etag
+
+    # the resource was modified since `etag`
+    result = make_call("PATCH", "/store/resources/{}".format(uid),
+                       json={"data": {"body": {"name": "h"}}},
+                       headers={"If-Match": etag})
+    assert result.status_code == 412
+    assert db_contains_object(db, {"type": TYPE, "body": {"name": "g", "email": "a@a.com"}})
+    assert make_call("DELETE", "/store/resources/{}".format(uid),
+                     headers={"If-Match": etag}).status_code == 412
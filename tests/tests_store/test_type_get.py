@@ -19,6 +19,28 @@ def test_storage_type_get(tozti, db):
 
     assert ids == {uid_bar, uid_bar2}
 
+@pytest.mark.extensions("rel02")
+def test_storage_type_get_pages(tozti, db):
+    uids = {add_object_get_id({"type": "rel02/bar", "body": {"bar": "bar"}}) for _ in range(5)}
+
+    seen = []
+    path = "/store/by-type/rel02/bar?page[size]=2&sort=-created"
+    while path is not None:
+        resp = make_call("GET", path)
+        assert resp.status_code == 200
+        assert len(resp.json()['data']) <= 2
+        seen.extend(d['id'] for d in resp.json()['data'])
+        next = resp.json()['links']['next']
+        path = None if next is None else next[next.index('/store/'):]
+
+    assert len(seen) == 5
+    assert set(seen) == uids
+
+@pytest.mark.extensions("rel02")
+def test_storage_type_get_bad_sort(tozti, db):
+    resp = make_call("GET", "/store/by-type/rel02/bar?sort=bar")
+    assert resp.status_code == 400
+
 @pytest.mark.extensions("rel02")
 def test_storage_type_get_empty(tozti, db):
     uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": []}}})
@@ -42,3 +64,25 @@ def test_storage_type_get_nonexistent(tozti, db):
 def test_storage_type_get_nonexistent_long(tozti, db):
     resp = make_call("GET", "/store/by-type/a/bit/long")
     assert resp.status_code == 404
+
+@pytest.mark.extensions("rel02")
+def test_storage_type_get_filter(tozti, db):
+    uid_bar = add_object_get_id({"type": "rel02/bar", "body": {"bar": "a"}})
+    uid_bar2 = add_object_get_id({"type": "rel02/bar", "body": {"bar": "b"}})
+    uid_foo = add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": [{"id": uid_bar}]}}})
+    add_object_get_id({"type": "rel02/foo", "body": {"foo": "foo", "members": {"data": [{"id": uid_bar2}]}}})
+
+    resp = make_call("GET", "/store/by-type/rel02/bar?filter[bar]=b")
+    assert [d['id'] for d in resp.json()['data']] == [uid_bar2]
+
+    resp = make_call("GET", "/store/by-type/rel02/bar?filter[bar][in]=a,b")
+    assert {d['id'] for d in resp.json()['data']} == {uid_bar, uid_bar2}
+
+    resp = make_call("GET", "/store/by-type/rel02/foo?filter[members][contains]={}".format(uid_bar))
+    assert [d['id'] for d in resp.json()['data']] == [uid_foo]
+
+@pytest.mark.extensions("rel02")
+def test_storage_type_get_bad_filter(tozti, db):
+    assert make_call("GET", "/store/by-type/rel02/bar?filter[nope]=a").status_code == 400
+    assert make_call("GET", "/store/by-type/rel02/bar?filter[bar][foo]=a").status_code == 400
+    assert make_call("GET", "/store/by-type/rel02/foo?filter[members]=a").status_code == 400
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from tozti.store import UploadTooLargeError, UploadBusyError
+from tozti.store.blobs import LocalStorage
+from tozti.store.uploads import upload_digest, ChunkStream, ConcatStream
+
+
+class Stream:
+    def __init__(self, data, fail=False):
+        self.data = data
+        self.fail = fail
+
+    async def read(self, n):
+        if self.fail and not self.data:
+            raise ConnectionResetError()
+        chunk, self.data = self.data[:n], self.data[n:]
+        return chunk
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def read_all(reader):
+    data = b''
+    async for chunk in reader:
+        data += chunk
+    return data
+
+
+@pytest.mark.parametrize('fsync', ['never', 'file', 'full'])
+def test_local_storage(tmpdir, fsync):
+    storage = LocalStorage(str(tmpdir), fsync=fsync, chunk_size=4096)
+    data = os.urandom(100000)
+    tmp, size, digest = run(storage.write(Stream(data)))
+    assert size == len(data)
+    assert digest == hashlib.sha256(data).hexdigest()
+
+    assert run(storage.publish(tmp, digest))
+    assert os.listdir(str(tmpdir)) == [digest]
+    assert run(storage.size(digest)) == len(data)
+    assert run(read_all(run(storage.read(digest)))) == data
+    assert run(read_all(run(storage.read(digest, 10, 5000)))) == data[10:5000]
+
+    run(storage.remove(digest))
+    assert run(storage.size(digest)) is None
+
+
+def test_local_storage_publish_existing(tmpdir):
+    storage = LocalStorage(str(tmpdir))
+    created = []
+    for _ in range(2):
+        tmp, _, digest = run(storage.write(Stream(b'foo')))
+        created.append(run(storage.publish(tmp, digest)))
+    assert created == [True, False]
+    assert os.listdir(str(tmpdir)) == [digest]
+
+
+def test_local_storage_too_large(tmpdir):
+    storage = LocalStorage(str(tmpdir), chunk_size=1000)
+    with pytest.raises(UploadTooLargeError):
+        run(storage.write(Stream(b'x' * 10000), max_size=5000))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_local_storage_names(tmpdir):
+    storage = LocalStorage(str(tmpdir))
+    with pytest.raises(ValueError):
+        storage.path('../config.toml')
+
+
+def test_chunk_stream():
+    stream = ChunkStream(Stream(b'hello', fail=True), 100)
+    assert run(stream.read(3)) == b'hel'
+    assert run(stream.read(3)) == b'lo'
+    assert run(stream.read(3)) == b''
+    assert isinstance(stream.error, ConnectionResetError)
+
+    stream = ChunkStream(Stream(b'hello'), 4)
+    assert run(stream.read(3)) == b'hel'
+    assert run(stream.read(3)) == b'l'
+    assert run(stream.read(3)) == b''
+    assert isinstance(stream.error, UploadTooLargeError)
+
+    stream = ChunkStream(Stream(b'hello'), 100)
+    assert run(stream.read(3)) == b'hel'
+    stream.abort(UploadBusyError(id=1))
+    assert run(stream.read(3)) == b''
+    assert isinstance(stream.error, UploadBusyError)
+
+
+def test_concat_stream(tmpdir):
+    storage = LocalStorage(str(tmpdir), chunk_size=2)
+    names = [run(storage.write(Stream(data)))[0]
+             for data in (b'hello', b'', b' world')]
+    tmp, size, digest = run(storage.write(ConcatStream(storage, names)))
+    assert digest == hashlib.sha256(b'hello world').hexdigest()
+
+
+def test_upload_digest():
+    digest = hashlib.sha256(b'foo').hexdigest()
+    assert upload_digest('http://localhost/uploads/' + digest) == digest
+    assert upload_digest('http://localhost/uploads/foo') is None
+    assert upload_digest(None) is None
+
+
+def test_local_storage_append(tmpdir):
+    storage = LocalStorage(str(tmpdir), chunk_size=2)
+    name = run(storage.create())
+    assert run(storage.append(name, Stream(b'hello'), 0)) == 5
+    # what follows the offset is overwritten
+    assert run(storage.append(name, Stream(b' world'), 4)) == 6
+    assert run(storage.digest(name)) == hashlib.sha256(b'hell world').hexdigest()
+    assert run(read_all(run(storage.read(name)))) == b'hell world'
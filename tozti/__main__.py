@@ -27,6 +27,7 @@ import toml
 
 import tozti
 import tozti.store
+import tozti.store.commands
 import tozti.app
 import tozti.auth
 from tozti.utils import ConfigError
@@ -132,7 +133,13 @@ def main():
     parser.add_argument(
         '-c', '--config', default=os.path.join(tozti.TOZTI_BASE, 'config.toml'),
         help='configuration file (default: `TOZTI/config.toml`)')
-    parser.add_argument('command', choices=('dev', 'prod'))
+    parser.add_argument(
+        'command',
+        choices=('dev', 'prod') + tuple(tozti.store.commands.COMMANDS),
+        help='start the server (`dev` or `prod`) or run a maintenance command')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='maintenance commands only report what they would do')
     args = parser.parse_args()
 
     tozti.PRODUCTION = args.command == 'prod'
@@ -177,6 +184,14 @@ def main():
                         .format(err), exc_info=sys.exc_info())
         sys.exit(1)
 
+    if args.command in tozti.store.commands.COMMANDS:
+        try:
+            sys.exit(app.run_command(args.command, check=args.check))
+        except Exception as err:
+            logger.critical('Error while running {}: {}'.format(
+                            args.command, err), exc_info=sys.exc_info())
+            sys.exit(1)
+
     try:
         app.main()
     except tozti.app.DependencyCycle as err:
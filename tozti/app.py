@@ -31,8 +31,10 @@ from aiohttp import web
 import tozti
 from tozti.utils import APIError, json_response
 import tozti.store.routes
+import tozti.store.commands
 import tozti.auth
 from tozti.auth.middleware import auth_middleware
+from tozti.store.loader import loader_middleware
 from tozti.core_schemas import SCHEMAS
 
 
@@ -202,7 +204,8 @@ class App:
     """The Tozti server."""
 
     def __init__(self):
-        self._app = web.Application(middlewares=[error_handler, auth_middleware])
+        self._app = web.Application(
+            middlewares=[error_handler, loader_middleware, auth_middleware])
         self._static_dirs = {}
         self._dep_graph_includes = DependencyGraph()
         self._types = {}
@@ -272,7 +275,8 @@ class App:
             'store',
             router=tozti.store.routes.router,
             on_startup=partial(tozti.store.routes.open_db, types=self._types),
-            on_shutdown=tozti.store.routes.close_db))
+            on_shutdown=tozti.store.routes.close_db,
+            on_response_prepare=tozti.store.routes.upload_response_prepare))
 
         self.register(Extension(
             'core',
@@ -281,6 +285,26 @@ class App:
             types=SCHEMAS))
 
 
+    def run_command(self, command, loop=None, **kwargs):
+        """Run a store maintenance command instead of the server.
+
+        Returns the exit status of the command.
+        """
+
+        self.register_core()
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        loop.run_until_complete(
+            tozti.store.routes.open_db(self._app, types=self._types))
+        try:
+            run = tozti.store.commands.COMMANDS[command]
+            return loop.run_until_complete(
+                run(self._app['tozti-store'], **kwargs))
+        finally:
+            loop.run_until_complete(tozti.store.routes.close_db(self._app))
+
     def main(self, loop=None):
         """Start the server."""
 
@@ -288,13 +312,16 @@ class App:
 
         index_html = self._render_index()
 
+        for method in ('GET', 'HEAD'):
+            self._app.router.add_route(method, '/uploads/{name}',
+                                       tozti.store.routes.uploads_get)
+
         if tozti.PRODUCTION:
             #FIXME: deploy static files and index.html
             pass
         else:
             for (prefix, path) in self._static_dirs.items():
                 self._app.router.add_static('/static/{}'.format(prefix), path)
-            self._app.router.add_static('/uploads', tozti.CONFIG['http']['upload_dir'])
             async def index_handler(req):
                 return web.Response(text=index_html, content_type='text/html',
                                     charset='utf-8')
@@ -61,6 +61,62 @@ class BadRelError(BadItemError):
     template = 'relationship {key} is invalid: {err}'
 
 
+class BadQueryError(APIError):
+    code = 'BAD_QUERY'
+    title = 'a query parameter is invalid'
+    status = 400
+    template = 'query parameter {param} is invalid: {msg}'
+
+
+class VersionMismatchError(APIError):
+    code = 'VERSION_MISMATCH'
+    title = 'resource was modified'
+    status = 412
+    template = 'resource {id} is not at version {version}'
+
+
+class UploadTooLargeError(APIError):
+    code = 'UPLOAD_TOO_LARGE'
+    title = 'uploaded file is too large'
+    status = 413
+    template = 'uploaded file is larger than {max_size} bytes'
+
+
+class NoUploadError(APIError):
+    code = 'NO_UPLOAD'
+    title = 'unknown upload'
+    status = 404
+    template = 'upload {id} not found'
+
+
+class UploadOffsetError(APIError):
+    code = 'UPLOAD_OFFSET'
+    title = 'upload offset mismatch'
+    status = 409
+    template = 'upload {id} is at offset {offset}'
+
+
+class UploadBusyError(APIError):
+    code = 'UPLOAD_BUSY'
+    title = 'upload is being written'
+    status = 423
+    template = 'upload {id} is being written by another request'
+
+
+class UploadSweepingError(APIError):
+    code = 'UPLOAD_SWEEPING'
+    title = 'uploaded file is being removed'
+    status = 503
+    template = 'file {digest} is being removed, retry later'
+
+
+class BadHeaderError(APIError):
+    code = 'BAD_HEADER'
+    title = 'a header is invalid'
+    status = 400
+    template = 'header {header} is invalid: {msg}'
+
+
 class NoTypeError(APIError):
     code = 'NO_TYPE'
     title = 'unknown type'
@@ -0,0 +1,442 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Storage backends of the uploaded files."""
+
+
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+import os
+import re
+import tempfile
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+import tozti
+from tozti.store.uploads import copy_stream, DIGEST_RE
+
+
+# what is flushed to the disk before an upload is acknowledged: nothing,
+# the content of the file or the file and the directory entry
+FSYNC_POLICIES = ('never', 'file', 'full')
+
+# how the front proxy can be asked to send local files instead of tozti
+# (nothing, nginx or Apache and lighttpd), see `local_path`
+OFFLOAD_MODES = ('', 'x-accel-redirect', 'x-sendfile')
+
+# names which can be given to `LocalStorage`, so that no file outside of its
+# directory can be reached
+NAME_RE = re.compile(r'^\.?[\w-]+$')
+
+
+class BlobStorage(ABC):
+    """Interface of the storages of uploaded files.
+
+    A file is first written to a temporary blob with :meth:`write`, then
+    either published under the digest of its content with :meth:`publish`
+    or removed with :meth:`discard`. Published blobs are never modified,
+    only removed with :meth:`remove`. Blobs are identified by strings.
+
+    Storages which can write in the middle of a blob set :attr:`can_append`
+    and implement :meth:`create`, :meth:`append` and :meth:`digest`, so
+    that resumable uploads are written in place.
+
+    Implementations stream the content by chunks and never hold a whole file
+    in memory. A storage is built from the ``[store.uploads]`` section of
+    the configuration by its :meth:`from_config` class method, see
+    `STORAGES`.
+    """
+
+    can_append = False
+
+    @classmethod
+    @abstractmethod
+    def from_config(cls, config, db, executor):
+        """Build a storage from a configuration section, with the MongoDB
+        database `db` and the `executor` for blocking operations."""
+
+    @abstractmethod
+    async def write(self, stream, max_size=None):
+        """Write the content of a `StreamReader` to a new temporary blob.
+
+        Raise `UploadTooLargeError` if more than `max_size` bytes are read,
+        nothing is kept on errors. Return the name of the blob, its size and
+        the hex SHA-256 digest of its content.
+        """
+
+    @abstractmethod
+    async def publish(self, name, digest):
+        """Make the temporary blob `name` available under the name `digest`.
+
+        If a blob with this name already exists, it has the same content and
+        the temporary blob is discarded instead. Return whether the blob was
+        created.
+        """
+
+    @abstractmethod
+    async def discard(self, name):
+        """Remove a temporary blob, if it exists."""
+
+    @abstractmethod
+    async def remove(self, digest):
+        """Remove a published blob, if it exists."""
+
+    @abstractmethod
+    async def size(self, name):
+        """Return the size of a blob, or `None` if it does not exist."""
+
+    @abstractmethod
+    async def read(self, name, start=0, end=None):
+        """Return an asynchronous iterator on the chunks of the bytes `start`
+        to `end` (excluded, the end of the blob if `None`) of a blob."""
+
+    async def create(self):
+        """Create an empty temporary blob written by :meth:`append` and
+        return its name."""
+
+        raise NotImplementedError()
+
+    async def append(self, name, stream, offset, max_size=None):
+        """Write the content of a `StreamReader` at `offset` in the
+        temporary blob `name`, dropping what follows, and return the number
+        of bytes written.
+
+        On errors, the content after `offset` is undefined.
+        """
+
+        raise NotImplementedError()
+
+    async def digest(self, name):
+        """Return the hex SHA-256 digest of the content of a temporary
+        blob."""
+
+        raise NotImplementedError()
+
+    def local_path(self, name):
+        """Return the path of the local file of a blob, if there is one, so
+        that it can be sent with ``sendfile`` or by a front proxy."""
+
+        return None
+
+
+def _write_chunk(file, hasher, chunk):
+    # hashlib releases the GIL on large buffers, this runs in a thread
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def _sync_file(file, fsync):
+    file.flush()
+    if fsync != 'never':
+        os.fsync(file.fileno())
+    file.close()
+
+
+def _create(directory):
+    (fd, path) = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    os.close(fd)
+    return os.path.basename(path)
+
+
+def _open_at(path, offset):
+    file = open(path, 'r+b')
+    file.seek(offset)
+    file.truncate()
+    return file
+
+
+def _hash_file(path, chunk_size):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _sync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _discard(file, path):
+    file.close()
+    _remove(path)
+
+
+def _publish(tmp, path, fsync):
+    if os.path.exists(path):
+        _remove(tmp)
+        return False
+    os.replace(tmp, path)
+    if fsync == 'full':
+        _sync_dir(os.path.dirname(path) or '.')
+    return True
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+
+
+def _open(path, start):
+    file = open(path, 'rb')
+    file.seek(start)
+    return file
+
+
+class LocalReader:
+    def __init__(self, path, start, end, chunk_size, executor):
+        self._path = path
+        self._start = start
+        self._left = end - start if end is not None else None
+        self._chunk_size = chunk_size
+        self._executor = executor
+        self._file = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_event_loop()
+        if self._file is None:
+            self._file = await loop.run_in_executor(
+                self._executor, _open, self._path, self._start)
+        n = self._chunk_size
+        if self._left is not None:
+            n = min(n, self._left)
+        chunk = await loop.run_in_executor(self._executor, self._file.read, n)
+        if not chunk:
+            await loop.run_in_executor(self._executor, self._file.close)
+            raise StopAsyncIteration
+        if self._left is not None:
+            self._left -= len(chunk)
+        return chunk
+
+
+class LocalStorage(BlobStorage):
+    """Blobs stored as files in a local directory.
+
+    Disk operations are done by `executor` (the default executor of the loop
+    if `None`) so that the event loop is never blocked. `fsync` is one of
+    `FSYNC_POLICIES`.
+    """
+
+    can_append = True
+
+    def __init__(self, directory, fsync='file', chunk_size=65536,
+                 executor=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy %s' % fsync)
+        self.directory = directory
+        self.fsync = fsync
+        self.chunk_size = chunk_size
+        self._executor = executor
+
+    @classmethod
+    def from_config(cls, config, db, executor):
+        return cls(tozti.CONFIG['http']['upload_dir'],
+                   fsync=config.get('fsync', 'file'),
+                   chunk_size=config.get('chunk_size', 65536),
+                   executor=executor)
+
+    def path(self, name):
+        """Return the path of the file of a blob."""
+
+        if not NAME_RE.match(name):
+            raise ValueError('invalid blob name %s' % name)
+        return os.path.join(self.directory, name)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def write(self, stream, max_size=None):
+        fd, tmp = await self._run(lambda: tempfile.mkstemp(
+            dir=self.directory, prefix='.upload-'))
+        file = os.fdopen(fd, 'wb')
+        hasher = hashlib.sha256()
+
+        try:
+            size = await copy_stream(
+                stream, lambda chunk: self._run(_write_chunk, file, hasher, chunk),
+                max_size=max_size, chunk_size=self.chunk_size)
+            await self._run(_sync_file, file, self.fsync)
+        except BaseException:
+            await self._run(_discard, file, tmp)
+            raise
+
+        return os.path.basename(tmp), size, hasher.hexdigest()
+
+    async def create(self):
+        return await self._run(_create, self.directory)
+
+    async def append(self, name, stream, offset, max_size=None):
+        file = await self._run(_open_at, self.path(name), offset)
+        try:
+            return await copy_stream(
+                stream, lambda chunk: self._run(file.write, chunk),
+                max_size=max_size, chunk_size=self.chunk_size)
+        finally:
+            await self._run(_sync_file, file, self.fsync)
+
+    async def digest(self, name):
+        return await self._run(_hash_file, self.path(name), self.chunk_size)
+
+    async def publish(self, name, digest):
+        return await self._run(_publish, self.path(name), self.path(digest),
+                               self.fsync)
+
+    async def discard(self, name):
+        await self._run(_remove, self.path(name))
+
+    async def remove(self, digest):
+        await self._run(_remove, self.path(digest))
+
+    async def size(self, name):
+        return await self._run(_size, self.path(name))
+
+    def local_path(self, name):
+        return self.path(name)
+
+    async def read(self, name, start=0, end=None):
+        return LocalReader(self.path(name), start, end, self.chunk_size,
+                           self._executor)
+
+
+class GridFSReader:
+    def __init__(self, grid_out, start, end, chunk_size):
+        self._grid_out = grid_out
+        self._left = (end if end is not None else grid_out.length) - start
+        self._chunk_size = chunk_size
+        grid_out.seek(start)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._left <= 0:
+            raise StopAsyncIteration
+        chunk = await self._grid_out.read(min(self._chunk_size, self._left))
+        if not chunk:
+            raise StopAsyncIteration
+        self._left -= len(chunk)
+        return chunk
+
+
+class GridFSStorage(BlobStorage):
+    """Blobs stored in MongoDB with GridFS, in the bucket `bucket` of `db`.
+
+    Every tozti process connected to the same database shares the blobs.
+    Temporary blobs are named after the id of their GridFS file.
+    """
+
+    def __init__(self, db, bucket='blobs', chunk_size=261120):
+        self.chunk_size = chunk_size
+        self._bucket = AsyncIOMotorGridFSBucket(db, bucket)
+
+    @classmethod
+    def from_config(cls, config, db, executor):
+        return cls(db, bucket=config.get('bucket', 'blobs'),
+                   chunk_size=config.get('chunk_size', 261120))
+
+    async def _ids(self, filename):
+        files = self._bucket.find({'filename': filename})
+        return [f._id for f in await files.to_list(None)]
+
+    async def write(self, stream, max_size=None):
+        grid_in = self._bucket.open_upload_stream(
+            '.upload', chunk_size_bytes=self.chunk_size)
+        hasher = hashlib.sha256()
+
+        def write(chunk):
+            # hashing a chunk takes far less time than sending it to MongoDB
+            hasher.update(chunk)
+            return grid_in.write(chunk)
+
+        try:
+            size = await copy_stream(stream, write, max_size=max_size,
+                                     chunk_size=self.chunk_size)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+
+        return str(grid_in._id), size, hasher.hexdigest()
+
+    async def publish(self, name, digest):
+        if await self._ids(digest):
+            await self.discard(name)
+            return False
+        await self._bucket.rename(ObjectId(name), digest)
+        return True
+
+    async def discard(self, name):
+        try:
+            await self._bucket.delete(ObjectId(name))
+        except (InvalidId, NoFile):
+            pass
+
+    async def remove(self, digest):
+        for id in await self._ids(digest):
+            try:
+                await self._bucket.delete(id)
+            except NoFile:
+                pass
+
+    async def _open(self, name):
+        try:
+            if DIGEST_RE.match(name):
+                return await self._bucket.open_download_stream_by_name(name)
+            return await self._bucket.open_download_stream(ObjectId(name))
+        except (InvalidId, NoFile):
+            return None
+
+    async def size(self, name):
+        grid_out = await self._open(name)
+        return grid_out.length if grid_out is not None else None
+
+    async def read(self, name, start=0, end=None):
+        grid_out = await self._open(name)
+        if grid_out is None:
+            raise FileNotFoundError(name)
+        return GridFSReader(grid_out, start, end, self.chunk_size)
+
+
+# storages which can be selected with the `storage` option of the
+# `[store.uploads]` section of the configuration
+STORAGES = {
+    'local': LocalStorage,
+    'gridfs': GridFSStorage,
+}
@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+from sys import intern
+from time import monotonic
+
+
+class ResourceCache:
+    """Bounded LRU cache of raw resource documents with expiration.
+
+    At most `size` documents are kept (``0`` disables the cache) and entries
+    older than `ttl` seconds are dropped (``0`` means they never expire).
+    Cached documents are shared, they must not be modified. The cache is
+    also used for handle resolutions, keyed by handle.
+
+    To avoid caching a document which was read before a concurrent write but
+    returned after it, :meth:`put` takes the :attr:`generation` observed
+    before querying the database and ignores the document if something was
+    invalidated in between.
+    """
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, id, default=None):
+        """Return the cached document with given id or `default`."""
+
+        entry = self._entries.get(id)
+        if entry is not None and entry[0] is not None and entry[0] < monotonic():
+            del self._entries[id]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(id)
+        return entry[1]
+
+    def put(self, id, doc, generation, ttl=None):
+        """Cache a document read from the database.
+
+        `ttl` overrides the expiration delay of the cache for this entry.
+        """
+
+        if self.size <= 0 or generation != self.generation:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[id] = (monotonic() + ttl if ttl > 0 else None, doc)
+        self._entries.move_to_end(id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *ids):
+        """Drop the documents with given ids."""
+
+        self.generation += 1
+        for id in ids:
+            self._entries.pop(id, None)
+
+    def clear(self):
+        """Drop every document."""
+
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        """Return the counters of the cache."""
+
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TypeCache:
+    """Bounded map from resource ids to their type.
+
+    The type of a resource never changes, so entries never expire: they are
+    only dropped when the resource is deleted or when more than `size` ids
+    are known (least recently used first). To keep the map compact, keys are
+    the 16 bytes of the UUIDs and type names are interned.
+
+    As for `ResourceCache`, :meth:`put` takes the :attr:`generation` observed
+    before querying the database, so that a resource deleted meanwhile is not
+    added back. Entries may still outlive resources deleted by other
+    processes: the cache must not be used to check that a resource exists.
+    """
+
+    def __init__(self, size=1000000):
+        self.size = size
+        self.generation = 0
+        self._types = OrderedDict()
+
+    def get(self, id):
+        """Return the type of the resource with given id or `None`."""
+
+        type = self._types.get(id.bytes)
+        if type is not None:
+            self._types.move_to_end(id.bytes)
+        return type
+
+    def put(self, id, type, generation):
+        """Remember the type of a resource read from the database."""
+
+        if self.size <= 0 or generation != self.generation:
+            return
+        self._types[id.bytes] = intern(type)
+        self._types.move_to_end(id.bytes)
+        while len(self._types) > self.size:
+            self._types.popitem(last=False)
+
+    def discard(self, id):
+        """Forget a deleted resource."""
+
+        self.generation += 1
+        self._types.pop(id.bytes, None)
+
+    def __len__(self):
+        return len(self._types)
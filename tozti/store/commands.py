@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Maintenance commands on the store, run with ``python -m tozti <command>``.
+
+Every command is a coroutine taking the `Store` and the ``check`` flag (only
+report what would be done) and returning the exit status.
+"""
+
+
+from tozti.store import logger
+
+
+async def rebuild_inverses(store, check=False):
+    """Reconstruct (or verify) the materialized `auto` relationships."""
+
+    if not store._config.get('materialize_auto', False):
+        logger.error('materialize_auto is disabled in the [store] section: '
+                     'auto relationships are not stored, nothing to rebuild')
+        return 1
+
+    fixed = await store.rebuild_inverses(check=check)
+    if check:
+        logger.info('{} resources out of sync'.format(fixed))
+        return 1 if fixed > 0 else 0
+    logger.info('{} resources fixed'.format(fixed))
+    return 0
+
+
+async def indexes(store, check=False):
+    """Create (or verify) the indexes needed by the registered types."""
+
+    missing, unknown = await store.ensure_indexes(check=check)
+    if check:
+        return 1 if len(missing) + len(unknown) > 0 else 0
+    return 0
+
+
+async def collect_references(store, check=False):
+    """Remove (or report) the linkages and handles pointing to deleted
+    resources."""
+
+    missing = list(await store.dangling_references())
+    logger.info('{} missing resources are referenced'.format(len(missing)))
+    batch_size = store._config.get('gc', {}).get('batch_size', 100)
+    fixed = 0
+    for i in range(0, len(missing), batch_size):
+        fixed += await store.collect_references(missing[i:i+batch_size],
+                                                check=check)
+        logger.info('Processed {}/{} missing resources'.format(
+            min(i + batch_size, len(missing)), len(missing)))
+
+    if check:
+        logger.info('{} resources and handles to fix'.format(fixed))
+        return 1 if fixed > 0 else 0
+    logger.info('{} resources and handles fixed'.format(fixed))
+    return 0
+
+
+async def sweep_uploads(store, check=False):
+    """Remove (or report) the uploaded files which are no longer referenced
+    by any resource and the expired resumable uploads."""
+
+    removed = await store.sweep_uploads(check=check)
+    expired = await store.expire_uploads(check=check)
+    if check:
+        logger.info('{} unreferenced uploads, {} expired partial uploads'
+                    .format(removed, expired))
+        return 1 if removed + expired > 0 else 0
+    logger.info('{} unreferenced uploads and {} expired partial uploads '
+                'removed'.format(removed, expired))
+    return 0
+
+
+COMMANDS = {
+    'rebuild-inverses': rebuild_inverses,
+    'indexes': indexes,
+    'collect-references': collect_references,
+    'sweep-uploads': sweep_uploads,
+}
@@ -16,62 +16,752 @@
 # along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os.path
-from datetime import datetime, timezone
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import re
+from datetime import datetime, timedelta, timezone
+from time import monotonic
 from uuid import uuid4, UUID
 import asyncio
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from tozti.store import logger, NoResourceError, NoTypeError, BadItemError, NoItemError, NoHandleError, HandleExistsError
+import tozti
+from tozti.store import logger, NoResourceError, NoTypeError, BadItemError, NoItemError, NoHandleError, HandleExistsError, BadQueryError, VersionMismatchError, UploadTooLargeError, NoUploadError, UploadOffsetError, UploadBusyError, UploadSweepingError
+from tozti.store.cache import ResourceCache, TypeCache
+from tozti.store.loader import current_loader, ResourceLoader
 from tozti.store.schema import Schema, fmt_resource_url
-from tozti.utils import BadDataError, ValidationError, validate, NotAcceptableError
+from tozti.store.blobs import STORAGES, OFFLOAD_MODES
+from tozti.store.uploads import (upload_digest, ChunkStream, ConcatStream,
+                                 DIGEST_RE)
+from tozti.utils import APIError, BadDataError, ValidationError, validate, NotAcceptableError
 
 from tozti.auth.utils import LoginUnknown as LoginUnknown
 
 
-def fmt_upload_url(id):
-    return 'http://{hostname}/uploads/{id}'.format(
-        id=id, hostname=tozti.CONFIG['http']['hostname'])
+def fmt_upload_url(digest):
+    # the content at this url never changes, it is named after its digest
+    return 'http://{hostname}/uploads/{digest}'.format(
+        digest=digest, hostname=tozti.CONFIG['http']['hostname'])
+
+
+# cached resolution of a handle which does not exist
+NO_HANDLE = None
+# returned by the handle cache on a miss
+UNKNOWN = object()
+
+# names of the files uploaded before they were content-addressed
+UPLOAD_UUID_RE = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# seconds after which the sweeper which claimed an unreferenced upload is
+# assumed to have crashed
+SWEEP_TIMEOUT = 600
+# seconds an upload waits for the sweeper to remove a previous copy of the
+# same file
+ACQUIRE_TIMEOUT = 30
+# seconds after which a request appending to a resumable upload which no
+# longer refreshes its claim is assumed to have crashed
+WRITE_TIMEOUT = 60
+
+# keys by which resources of a type can be sorted, besides their id
+SORT_KEYS = ('created', 'last-modified')
+
+
+def parse_date(value):
+    """Parse a date in the ISO 8601 format we output."""
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid date %s' % value)
+
+
+def fields_projection(keys):
+    """Return the MongoDB projection reading only the body items `keys`."""
+
+    projection = {'type': 1, 'created': 1, 'last-modified': 1, 'version': 1}
+    projection.update(('body.%s' % key, 1) for key in keys)
+    return projection
+
+
+def widen_fields(fields, tree):
+    """Add the relationship names of an include `tree` (see
+    `Store.include_paths`) to the sparse fieldsets `fields`, so that the
+    include paths can be followed."""
+
+    if not fields or not tree:
+        return fields
+    keys = set()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        keys.update(node)
+        nodes.extend(node.values())
+    return {type: names | keys for (type, names) in fields.items()}
+
+
+def restrict_fields(res, fields):
+    """Drop the body items of a rendered resource which are not in its
+    sparse fieldset."""
+
+    if fields and res['type'] in fields:
+        names = fields[res['type']]
+        res['body'] = {k: v for (k, v) in res['body'].items() if k in names}
+
+
+class ResourcePage:
+    """Asynchronous iterator over the linkages of a page of resources.
+
+    See `Store.type_page`. Once exhausted, `next` is the cursor of the next
+    page or `None` if this is the last one. If `fields` is given, the
+    resources are rendered by `schema` with only these body items instead.
+    """
+
+    def __init__(self, cursor, type, size, key, schema=None, fields=None):
+        # the cursor yields at most one more resource than the page size
+        self._iterator = cursor.__aiter__()
+        self._type = type
+        self._size = size
+        self._key = key
+        self._schema = schema
+        self._fields = fields
+        self._count = 0
+        self._last = None
+        self.next = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        hit = await self._iterator.__anext__()
+        if self._count == self._size:
+            if self._key is None:
+                self.next = str(self._last['_id'])
+            else:
+                self.next = '%s,%s' % (self._last[self._key].isoformat(),
+                                       self._last['_id'])
+            raise StopAsyncIteration
+
+        self._count += 1
+        self._last = hit
+        if self._fields is not None:
+            return await self._schema.render(hit, self._fields)
+        return {'id': hit['_id'],
+                'type': self._type,
+                'href': fmt_resource_url(hit['_id'])}
+
+
+def touch(update):
+    """Return a copy of a MongoDB update of resources which also increments
+    their version and sets their last modification date.
+
+    Every write to a resource must go through this, the version is used as
+    an entity tag (see `Store.validators`).
+    """
+
+    update = dict(update)
+    update['$set'] = dict(update.get('$set', {}))
+    update['$set']['last-modified'] = datetime.utcnow().replace(microsecond=0)
+    update['$inc'] = dict(update.get('$inc', {}), version=1)
+    return update
+
+
+def version_query(id, version=None):
+    """Return the MongoDB filter matching a resource, only at the given
+    `version` if it is not `None`."""
+
+    query = {'_id': id}
+    if version == 0:
+        # resources created before versions were introduced
+        query['version'] = {'$exists': False}
+    elif version is not None:
+        query['version'] = version
+    return query
+
+
+def link_ids(value):
+    """Return the set of target ids of a stored relationship value."""
+
+    if value is None:
+        return set()
+    if isinstance(value, dict):
+        value = [value]
+    return {UUID(str(link['id'])) for link in value}
+
+
+def linked_ids(rel):
+    """Return the list of target ids of a rendered relationship."""
+
+    links = rel['data']
+    if links is None:
+        return []
+    if isinstance(links, dict):
+        return [links['id']]
+    return [link['id'] for link in links]
 
 
 class Store:
-    def __init__(self, types, **kwargs):
+    """The resource store.
+
+    `types` maps type names to raw type definitions, `config` is the ``store``
+    section of the configuration file and any other argument is given to the
+    MongoDB client.
+    """
+
+    def __init__(self, types, config=None, **kwargs):
         self._client = AsyncIOMotorClient(**kwargs)
         self._db = self._client.tozti
-        self._types = {k: Schema(k, v, db=self) for (k, v) in types.items()}
+        self._config = config if config is not None else {}
+        concurrency = self._config.get('render_concurrency', 8)
+        self._types = {k: Schema(k, v, db=self, concurrency=concurrency)
+                       for (k, v) in types.items()}
+        self._tasks = []
+        # deleted resources whose references are still to be collected
+        self._garbage = set()
+        self._garbage_event = None
+
+        cache_config = self._config.get('cache', {})
+        self._cache = ResourceCache(size=cache_config.get('size', 10000),
+                                    ttl=cache_config.get('ttl', 60))
+        self._type_cache = TypeCache(size=cache_config.get('types', 1000000))
+        self._handle_cache = ResourceCache(
+            size=cache_config.get('handles', 10000),
+            ttl=cache_config.get('handle_ttl', 60))
+        self._handle_negative_ttl = cache_config.get('handle_negative_ttl', 5)
+
+        # uploaded files are written by dedicated threads, a slow disk must
+        # neither block the event loop nor the default executor
+        self._uploads_config = self._config.get('uploads', {})
+        self._upload_executor = ThreadPoolExecutor(
+            max_workers=self._uploads_config.get('threads', 4))
+        storage = self._uploads_config.get('storage', 'local')
+        if storage not in STORAGES:
+            raise ValueError('unknown upload storage %s' % storage)
+        offload = self._uploads_config.get('offload', '')
+        if offload not in OFFLOAD_MODES:
+            raise ValueError('unknown upload offload mode %s' % offload)
+        self._blobs = STORAGES[storage].from_config(
+            self._uploads_config, self._db, self._upload_executor)
+
+        # type -> relationship -> [(target type, auto relationship)]
+        self._inverses = {}
+        if self._config.get('materialize_auto', False):
+            for (name, schema) in self._types.items():
+                for (key, model) in schema.items():
+                    if getattr(model, 'arity', None) != 'auto':
+                        continue
+                    model.materialized = True
+                    for pred_type in model.pred_types:
+                        rels = self._inverses.setdefault(pred_type, {})
+                        rels.setdefault(model.pred_rel, []).append((name, key))
+
+        # keys which can be looked up with an index for a given type
+        self._indexed_keys = {keys[1][0] for keys in self.indexes()
+                              if keys[0][0] == 'type'}
+        self._unindexed = set()
+
+    async def start(self):
+        """Start the background tasks of the store."""
+
+        if self._config.get('cache', {}).get('watch', False):
+            self._tasks.append(asyncio.ensure_future(
+                self._watch_changes('resources', self._cache)))
+            self._tasks.append(asyncio.ensure_future(
+                self._watch_changes('handles', self._handle_cache)))
+        else:
+            ttls = [cache.ttl for cache in (self._cache, self._handle_cache)
+                    if cache.size > 0]
+            if ttls:
+                logger.warning(
+                    'cache.watch is disabled: writes made by other processes '
+                    'are seen {}, enable it or disable the cache when running '
+                    'several tozti processes'.format(
+                        'only when the entries are evicted' if min(ttls) <= 0
+                        else 'after up to {}s'.format(max(ttls))))
+        if self._config.get('manage_indexes', True):
+            self._tasks.append(asyncio.ensure_future(self._startup_indexes()))
+        if self._config.get('gc', {}).get('enabled', True):
+            self._garbage_event = asyncio.Event()
+            self._tasks.append(asyncio.ensure_future(self._collect_garbage()))
+        if self._uploads_config.get('sweep_interval', 600) > 0:
+            self._tasks.append(asyncio.ensure_future(self._sweep_uploads()))
+
+    def indexes(self):
+        """Return the indexes needed on the resources, as lists of keys.
+
+        These are the indexes used to list the resources of a type (in every
+        supported order) and the ones required by the registered types (see
+        `Schema.indexes`).
+        """
+
+        wanted = [[('type', ASCENDING), ('_id', ASCENDING)]]
+        wanted.extend([('type', ASCENDING), (key, ASCENDING), ('_id', ASCENDING)]
+                      for key in SORT_KEYS)
+        for schema in self._types.values():
+            for keys in schema.indexes():
+                if keys not in wanted:
+                    wanted.append(keys)
+        return wanted
+
+    async def ensure_indexes(self, check=False):
+        """Create the missing indexes on the resources and report the drift.
+
+        Indexes are built in the background. If `check` is true, nothing is
+        created. Returns the lists of missing indexes and of indexes not used
+        by any type.
+        """
+
+        info = await self._db.resources.index_information()
+        existing = [[tuple(k) for k in idx['key']]
+                    for (name, idx) in info.items() if name != '_id_']
+        wanted = self.indexes()
+        missing = [keys for keys in wanted if keys not in existing]
+        unknown = [keys for keys in existing if keys not in wanted]
+
+        for keys in unknown:
+            logger.warning('Index {} is not needed by any type'.format(keys))
+        if check:
+            for keys in missing:
+                logger.warning('Index {} is missing'.format(keys))
+        elif len(missing) > 0:
+            logger.info('Creating indexes {}'.format(missing))
+            await self._db.resources.create_indexes(
+                [IndexModel(keys, background=True) for keys in missing])
+        if not check:
+            # unreferenced uploads and expired partial uploads, see
+            # `sweep_uploads` and `expire_uploads`
+            await self._db.uploads.create_index(
+                'released', sparse=True, background=True)
+            await self._db.partial_uploads.create_index(
+                'expires', background=True)
+        return missing, unknown
+
+    async def _startup_indexes(self):
+        try:
+            await self.ensure_indexes()
+        except Exception as err:
+            logger.error('Could not create indexes: {}'.format(err))
+
+    async def _watch_changes(self, collection, cache):
+        """Invalidate the entries of `cache` written by other processes in
+        `collection` (``resources`` or ``handles``).
+
+        This relies on MongoDB change streams, which need a replica set. If
+        the stream fails the whole cache is dropped and it is reopened.
+        """
+
+        while True:
+            try:
+                async with self._db[collection].watch() as stream:
+                    async for change in stream:
+                        if 'documentKey' in change:
+                            id = change['documentKey']['_id']
+                            cache.invalidate(id)
+                            if (collection == 'resources' and
+                                    change['operationType'] == 'delete'):
+                                self._type_cache.discard(id)
+                        else:
+                            cache.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.error('Change stream of {} failed: {}'.format(
+                    collection, err))
+                cache.clear()
+                await asyncio.sleep(5)
+
+    async def _sync_inverses(self, id, type, rel, added=(), removed=()):
+        """Update the materialized `auto` relationships pointing back at a
+        relationship.
+
+        `added` (resp. `removed`) are the ids of the resources which are now
+        (resp. no longer) targets of the relationship `rel` of the resource
+        `id` of type `type`. Does nothing if no `auto` relationship is
+        materialized for `rel`.
+        """
+
+        for (target_type, auto) in self._inverses.get(type, {}).get(rel, ()):
+            path = 'body.%s' % auto
+            if len(removed) > 0:
+                await self._db.resources.update_many(
+                    {'_id': {'$in': list(removed)}, 'type': target_type},
+                    touch({'$pull': {path: {'id': id}}}))
+            if len(added) > 0:
+                await self._db.resources.update_many(
+                    {'_id': {'$in': list(added)}, 'type': target_type},
+                    touch({'$addToSet': {path: {'id': id, 'type': type}}}))
+            self._invalidate(*added)
+            self._invalidate(*removed)
+
+    async def _old_links(self, id, type, keys):
+        """Return the current targets of the materialized relationships among
+        `keys` of a resource, as a dictionary of sets of ids."""
+
+        tracked = [k for k in keys if k in self._inverses.get(type, {})]
+        if len(tracked) == 0:
+            return {}
+        doc = await self.resource_by_id(
+            id, {'body.%s' % k: 1 for k in tracked})
+        return {k: link_ids(doc['body'].get(k)) for k in tracked}
+
+    async def rebuild_inverses(self, check=False):
+        """Reconstruct every materialized `auto` relationship from scratch.
+
+        Nothing is done unless ``materialize_auto`` is enabled. If `check` is true, only report the resources which are out of sync.
+        Returns the number of resources that were (or would be) fixed.
+        """
+
+        fixed = 0
+        for (name, schema) in self._types.items():
+            for (key, model) in schema.items():
+                if not getattr(model, 'materialized', False):
+                    continue
+
+                logger.info('Rebuilding {}.{}'.format(name, key))
+                expected = {}
+                cursor = self._db.resources.find(
+                    {'type': {'$in': model.pred_types}},
+                    {'type': 1, 'body.%s' % model.pred_rel: 1})
+                async for hit in cursor:
+                    links = link_ids(hit['body'].get(model.pred_rel))
+                    for target in links:
+                        expected.setdefault(target, []).append(
+                            {'id': hit['_id'], 'type': hit['type']})
+
+                cursor = self._db.resources.find(
+                    {'type': name}, {'body.%s' % key: 1})
+                async for hit in cursor:
+                    current = hit['body'].get(key)
+                    wanted = expected.get(hit['_id'], [])
+                    if link_ids(current) == link_ids(wanted):
+                        continue
+                    fixed += 1
+                    if check:
+                        logger.warning('{} {}.{} is out of sync'.format(
+                            name, hit['_id'], key))
+                    else:
+                        await self._db.resources.update_one(
+                            {'_id': hit['_id']},
+                            touch({'$set': {'body.%s' % key: wanted}}))
+                        self._cache.invalidate(hit['_id'])
+        return fixed
+
+    def _stored_relationships(self):
+        """Yield the (type, key, arity) of the relationships whose linkages
+        are stored in the resources (`auto` ones are maintained by
+        `_sync_inverses`)."""
+
+        for (name, schema) in self._types.items():
+            for (key, model) in schema.items():
+                arity = getattr(model, 'arity', None)
+                if arity in ('to-one', 'to-many'):
+                    yield (name, key, arity)
+
+    async def collect_references(self, ids, check=False):
+        """Remove the linkages and the handles pointing to deleted resources.
+
+        `ids` is a list of ids of resources which no longer exist. Each
+        relationship is fixed with one `update_many` call over the resources
+        referencing them, dangling to-one relationships are set to null. If
+        `check` is true, nothing is modified. Returns the number of resources
+        and handles fixed (or to fix).
+        """
+
+        fixed = 0
+        for (type, key, arity) in self._stored_relationships():
+            path = 'body.%s' % key
+            query = {'type': type, '%s.id' % path: {'$in': ids}}
+            hits = []
+            async for hit in self._db.resources.find(query, {'_id': 1}):
+                hits.append(hit['_id'])
+            fixed += len(hits)
+            if check or len(hits) == 0:
+                continue
+
+            if arity == 'to-many':
+                update = {'$pull': {path: {'id': {'$in': ids}}}}
+            else:
+                update = {'$set': {path: None}}
+            query['_id'] = {'$in': hits}
+            await self._db.resources.update_many(query, touch(update))
+            self._cache.invalidate(*hits)
+
+        if check:
+            async for _ in self._db.handles.find({'target': {'$in': ids}}):
+                fixed += 1
+        else:
+            res = await self._db.handles.delete_many({'target': {'$in': ids}})
+            fixed += res.deleted_count
+            if res.deleted_count > 0:
+                self._handle_cache.clear()
+        return fixed
+
+    async def _collect_garbage(self):
+        """Collect the references to deleted resources in the background.
+
+        Deleted ids are processed by batches of ``gc.batch_size``, waiting
+        ``gc.delay`` seconds between batches so that the collection does not
+        compete with the requests. Ids still pending when the store is closed
+        are lost, the ``collect-references`` command finds them again.
+        """
+
+        config = self._config.get('gc', {})
+        batch_size = config.get('batch_size', 100)
+        delay = config.get('delay', 1.0)
+        while True:
+            await self._garbage_event.wait()
+            self._garbage_event.clear()
+            while self._garbage:
+                batch = [self._garbage.pop()
+                         for _ in range(min(batch_size, len(self._garbage)))]
+                try:
+                    fixed = await self.collect_references(batch)
+                    logger.debug('Collected {} references to {} deleted '
+                                 'resources'.format(fixed, len(batch)))
+                except Exception as err:
+                    logger.error('Could not collect references: {}'.format(err))
+                    self._garbage.update(batch)
+                await asyncio.sleep(delay)
+
+    async def dangling_references(self, batch_size=1000):
+        """Return the set of ids of missing resources which are referenced by
+        a stored relationship or a handle.
+
+        This scans every resource and handle, the progress is logged.
+        """
+
+        projection = {'type': 1}
+        keys = {}
+        for (type, key, _) in self._stored_relationships():
+            projection['body.%s' % key] = 1
+            keys.setdefault(type, []).append(key)
+
+        referenced = set()
+        scanned = 0
+        async for res in self._db.resources.find({}, projection):
+            for key in keys.get(res['type'], ()):
+                referenced.update(link_ids(res.get('body', {}).get(key)))
+            scanned += 1
+            if scanned % 10000 == 0:
+                logger.info('Scanned {} resources'.format(scanned))
+        logger.info('Scanned {} resources'.format(scanned))
+        async for handle in self._db.handles.find({}, {'target': 1}):
+            referenced.add(handle['target'])
+
+        missing = set()
+        referenced = list(referenced)
+        for i in range(0, len(referenced), batch_size):
+            batch = referenced[i:i+batch_size]
+            found = set()
+            cursor = self._db.resources.find({'_id': {'$in': batch}}, {'_id': 1})
+            async for res in cursor:
+                found.add(res['_id'])
+            missing.update(id for id in batch if id not in found)
+        return missing
+
+    def request_loader(self):
+        """Return a new loader for a request (see `tozti.store.loader`)."""
+
+        return ResourceLoader(self, size=self._config.get('loader_size', 1000))
+
+    def _invalidate(self, *ids):
+        """Drop written resources from the cache and from the loader of the
+        current request."""
+
+        self._cache.invalidate(*ids)
+        loader = current_loader()
+        if loader is not None:
+            loader.forget(*ids)
 
     async def resource_by_id(self, id, projection=None):
         """Returns the raw resource with given id.
 
         `id` must be an instance of `uuid.UUID`. Raises `NoResourceError` if
-        the resource is not found.
+        the resource is not found. Whole documents are cached: if the resource
+        is in the cache, it is returned even if a `projection` is given.
+        While a request is handled, the resource is read through its loader
+        (see `tozti.store.loader`).
         """
 
+        loader = current_loader()
+        if loader is not None:
+            res = await loader.load(id, projection)
+            if res is None:
+                raise NoResourceError(id=id)
+            return res
+
+        res = self._cache.get(id)
+        if res is not None:
+            return res
+
+        generation = self._cache.generation
+        type_generation = self._type_cache.generation
         logger.debug('querying DB for resource {}'.format(id))
         res = await self._db.resources.find_one({'_id': id}, projection=projection)
         if res is None:
             raise NoResourceError(id=id)
+        if 'type' in res:
+            self._type_cache.put(id, res['type'], type_generation)
+        if projection is None:
+            self._cache.put(id, res, generation)
         return res
 
+    async def _write(self, id, update, projection=None, version=None,
+                     before=False):
+        """Apply a MongoDB update to a resource and return the new document
+        (the old one if `before` is true).
+
+        This is a single `find_one_and_update` round trip, which also bumps
+        the version of the resource (see `touch`). If `version` is given, the
+        update is only applied if the resource is at this version, otherwise
+        `VersionMismatchError` is raised. Raises `NoResourceError` if the
+        resource is not found.
+        """
+
+        doc = await self._db.resources.find_one_and_update(
+            version_query(id, version), touch(update), projection=projection,
+            return_document=(ReturnDocument.BEFORE if before
+                             else ReturnDocument.AFTER))
+        self._invalidate(id)
+        if doc is None:
+            await self._missed(id, version)
+        return doc
+
+    async def _missed(self, id, version):
+        """Raise the error of a write which matched no resource."""
+
+        if version is not None:
+            if await self._db.resources.find_one({'_id': id}, {'_id': 1}):
+                raise VersionMismatchError(id=id, version=version)
+        raise NoResourceError(id=id)
+
+    async def validators(self, id, key=None, fields=None):
+        """Return the version and the last modification date of a resource.
+
+        They are read with a projection (or from the cache) and can be used
+        to answer conditional requests without rendering the resource or its
+        body item `key`. Returns `None` if the rendered form (restricted to
+        the sparse `fields`) does not only depend on the stored document,
+        because of `auto` relationships which are not materialized.
+        """
+
+        res = await self.resource_by_id(
+            id, {'type': 1, 'version': 1, 'last-modified': 1})
+        schema = self._types[res['type']]
+        if key is not None:
+            keys = [key]
+        elif fields and res['type'] in fields:
+            keys = fields[res['type']]
+        else:
+            keys = None
+        if not schema.is_stored(keys):
+            return None
+        return res.get('version', 0), res['last-modified']
+
+    async def resources_by_id(self, ids, projection=None):
+        """Return a dictionary mapping resource ids to raw resources.
+
+        `ids` must be an iterable of `uuid.UUID`. Same as `resource_by_id`,
+        but the resources which are not cached are fetched with a single
+        query. Resources which are not found are missing from the result.
+        """
+
+        loader = current_loader()
+        if loader is not None:
+            return await loader.load_many(ids, projection)
+        return await self._resources_by_id(ids, projection)
+
+    async def _resources_by_id(self, ids, projection=None):
+        """Same as `resources_by_id`, without the loader of the request."""
+
+        found = {}
+        missing = []
+        for id in set(ids):
+            res = self._cache.get(id)
+            if res is None:
+                missing.append(id)
+            else:
+                found[id] = res
+        if len(missing) == 0:
+            return found
+
+        generation = self._cache.generation
+        type_generation = self._type_cache.generation
+        logger.debug('querying DB for {} resources'.format(len(missing)))
+        cursor = self._db.resources.find({'_id': {'$in': missing}}, projection)
+        async for res in cursor:
+            found[res['_id']] = res
+            if 'type' in res:
+                self._type_cache.put(res['_id'], res['type'], type_generation)
+            if projection is None:
+                self._cache.put(res['_id'], res, generation)
+        return found
+
     async def type_by_id(self, id):
         """Return the type URL of a given resource.
 
         `id` must be an instance of `uuid.UUID`. Raises `NoResourceError` if
-        the resource is not found.
+        the resource is not found. Types are cached as they never change.
         """
 
+        type = self._type_cache.get(id)
+        if type is not None:
+            return type
+
         logger.debug('querying DB for type of resource {}'.format(id))
         res = await self.resource_by_id(id, {'type': 1})
         return res['type']
 
-    async def create(self, raw):
-        """Create a new resource and return it's rendered form.
+    async def types_by_id(self, ids, check=False):
+        """Return a dictionary mapping resource ids to their type URL.
 
-        The passed data must be the content of the request as specified by
-        JSON API. See https://jsonapi.org/format/#crud-creating.
+        `ids` must be an iterable of `uuid.UUID`. Every resource is looked up
+        in a single query, resources which are not found are simply missing
+        from the result.
+
+        The type cache may remember resources deleted since, by another
+        process or during the lookup. If `check` is true, it is not used:
+        only the resources in the resource cache or found in the database
+        are returned. Linkages are validated this way.
         """
 
+        types = {}
+        missing = []
+        for id in set(ids):
+            if check:
+                res = self._cache.get(id)
+                type = res['type'] if res is not None else None
+            else:
+                type = self._type_cache.get(id)
+            if type is None:
+                missing.append(id)
+            else:
+                types[id] = type
+        if len(missing) == 0:
+            return types
+
+        loader = current_loader()
+        if loader is not None:
+            found = await loader.load_many(missing, {'type': 1})
+            types.update((id, res['type']) for (id, res) in found.items())
+            return types
+
+        generation = self._type_cache.generation
+        logger.debug('querying DB for type of {} resources'.format(len(missing)))
+        cursor = self._db.resources.find({'_id': {'$in': missing}}, {'type': 1})
+        async for hit in cursor:
+            types[hit['_id']] = hit['type']
+            self._type_cache.put(hit['_id'], hit['type'], generation)
+        return types
+
+    async def _prepare(self, raw):
+        """Validate a creation request and return the document to insert."""
+
         try:
             tp = raw['data']['type']
         except (TypeError, KeyError):
@@ -86,46 +776,321 @@ class Store:
         current_time = datetime.utcnow().replace(microsecond=0)
         data['created'] = current_time
         data['last-modified'] = current_time
+        data['version'] = 1
+        return data
+
+    async def _inserted(self, data):
+        """Update the caches and relationships after inserting a resource."""
+
+        self._type_cache.put(data['_id'], data['type'],
+                             self._type_cache.generation)
+        for key in self._inverses.get(data['type'], {}):
+            await self._sync_inverses(data['_id'], data['type'], key,
+                                      added=link_ids(data['body'].get(key)))
+
+    async def create(self, raw):
+        """Create a new resource and return it's rendered form.
+
+        The passed data must be the content of the request as specified by
+        JSON API. See https://jsonapi.org/format/#crud-creating.
+        """
+
+        data = await self._prepare(raw)
         await self._db.resources.insert_one(data)
+        await self._inserted(data)
+
+        return await self._types[data['type']].render(data)
 
-        return await schema.render(data)
+    async def create_many(self, raws):
+        """Create several resources at once.
+
+        `raws` is a list of creation requests (see `create`). They are
+        validated one by one and inserted with a single unordered
+        `insert_many`. Returns a list with, for each request, either a
+        linkage to the new resource or the `APIError` that prevented its
+        creation.
+        """
+
+        results = []
+        docs = []
+        for raw in raws:
+            try:
+                docs.append(await self._prepare(raw))
+                results.append(None)
+            except APIError as err:
+                results.append(err)
+        if len(docs) == 0:
+            return results
+
+        failed = {}
+        try:
+            await self._db.resources.insert_many(docs, ordered=False)
+        except BulkWriteError as err:
+            for error in err.details['writeErrors']:
+                failed[error['index']] = error['errmsg']
 
-    async def read(self, id):
+        positions = [i for (i, res) in enumerate(results) if res is None]
+        for (index, data) in enumerate(docs):
+            if index in failed:
+                results[positions[index]] = APIError(
+                    'could not insert resource: {msg}', status=500,
+                    msg=failed[index])
+                continue
+            await self._inserted(data)
+            results[positions[index]] = {'id': data['_id'],
+                                         'type': data['type'],
+                                         'href': fmt_resource_url(data['_id'])}
+        return results
+
+    async def read(self, id, fields=None):
         """Query the DB for a resource.
 
         `id` must be an instance of `uuid.UUID`. Raises `NoResourceError` if
         the resource is not found. The answer is a JSON API _resource object_.
         See https://jsonapi.org/format/#document-resource-objects.
+
+        `fields` are sparse fieldsets (see `fieldsets`): if the type of the
+        resource is in it, only these body items are read and rendered.
+        """
+
+        projection = None
+        if fields:
+            type = self._type_cache.get(id)
+            if type in fields:
+                projection = fields_projection(fields[type])
+
+        res = await self.resource_by_id(id, projection)
+        schema = self._types[res['type']]
+        return await schema.render(res, fields.get(res['type']) if fields else None)
+
+    async def read_many(self, ids, fields=None):
+        """Query the DB for several resources at once.
+
+        Returns a list with, for each id of `ids`, either the rendered
+        resource (see `read`) or a `NoResourceError`. The projection of the
+        sparse `fields` is only used when they cover every resource.
+        """
+
+        projection = None
+        if fields:
+            types = {self._type_cache.get(id) for id in ids}
+            if all(type in fields for type in types):
+                projection = fields_projection(
+                    set().union(*(fields[type] for type in types)))
+
+        found = await self.resources_by_id(ids, projection)
+        results = []
+        for id in ids:
+            if id in found:
+                res = found[id]
+                results.append(await self._types[res['type']].render(
+                    res, fields.get(res['type']) if fields else None))
+            else:
+                results.append(NoResourceError(id=id))
+        return results
+
+    def fieldsets(self, params):
+        """Parse the ``fields[type]`` query parameters.
+
+        `params` maps type names to comma-separated lists of body items.
+        Returns a dictionary mapping type names to sets of item names. Raises
+        `BadQueryError` if a type or an item is unknown. See
+        https://jsonapi.org/format/#fetching-sparse-fieldsets.
+        """
+
+        fields = {}
+        for (type, value) in params.items():
+            param = 'fields[%s]' % type
+            if type not in self._types:
+                raise BadQueryError(param=param, msg='unknown type')
+            names = frozenset(value.split(',')) if value else frozenset()
+            for name in names:
+                if name not in self._types[type]:
+                    raise BadQueryError(param=param,
+                                        msg='%s has no item %s' % (type, name))
+            fields[type] = names
+        return fields
+
+    def include_paths(self, value):
+        """Parse the ``include`` query parameter.
+
+        `value` is a comma-separated list of dot-separated relationship paths
+        (eg ``groups,pinned.children``). Returns them as a tree: a dictionary
+        mapping relationship names to the paths following them. Raises
+        `BadQueryError` if a path is empty or longer than the
+        ``max_include_depth`` setting.
+        """
+
+        max_depth = self._config.get('max_include_depth', 3)
+        tree = {}
+        for path in value.split(','):
+            keys = path.split('.')
+            if '' in keys:
+                raise BadQueryError(param='include', msg='empty path')
+            if len(keys) > max_depth:
+                raise BadQueryError(
+                    param='include',
+                    msg='%s is longer than %d relationships' % (path, max_depth))
+            node = tree
+            for key in keys:
+                node = node.setdefault(key, {})
+        return tree
+
+    async def included(self, resources, tree, fields=None):
+        """Return the resources to include in a compound document.
+
+        `resources` are rendered resources (the primary data) and `tree` the
+        relationship paths to follow from them (see `include_paths`). Paths
+        going through items which are not relationships are ignored. See
+        https://jsonapi.org/format/#fetching-includes.
+
+        Included resources are restricted to the sparse `fields`. So that the
+        paths can be followed, `resources` must have been rendered with
+        ``widen_fields(fields, tree)``: they are restricted afterwards.
+        """
+
+        pending = []
+        for res in resources:
+            pending.extend(self._include_step(res, tree))
+        included = await self._include(
+            pending, {res['id']: res for res in resources}, tree, fields)
+        for res in resources:
+            restrict_fields(res, fields)
+        return included
+
+    async def included_links(self, links, tree, fields=None):
+        """Return the resources targeted by `links` and the ones reached from
+        them along the relationship paths of `tree` (see `included`)."""
+
+        return await self._include([(link['id'], tree) for link in links], {},
+                                   tree, fields)
+
+    async def item_included(self, id, key, rel, tree, fields=None):
+        """Return the resources to include with the relationship `key` of the
+        resource `id`.
+
+        `rel` is the rendered relationship (see `item_read`) and `tree` the
+        paths to follow from its targets, which are included too. Raises
+        `BadQueryError` if the item is not a relationship.
         """
 
-        res = await self.resource_by_id(id)
+        schema = self._types[await self.type_by_id(id)]
+        if getattr(schema[key], 'arity', None) is None:
+            raise BadQueryError(param='include',
+                                msg='%s is not a relationship' % key)
+        return await self._include(
+            [(target, tree) for target in linked_ids(rel)], {}, tree, fields)
+
+    def _include_step(self, res, tree):
+        """Return the (id, subtree) pairs reached in one step from the
+        rendered resource `res`."""
+
         schema = self._types[res['type']]
-        return await schema.render(res)
+        for (key, subtree) in tree.items():
+            if key not in res['body'] or getattr(schema[key], 'arity', None) is None:
+                continue
+            for target in linked_ids(res['body'][key]):
+                yield (target, subtree)
+
+    async def _include(self, pending, known, tree, fields):
+        """Fetch the resources of `pending`, a list of (id, subtree) pairs,
+        then follow the subtrees level by level.
+
+        `known` maps ids to the rendered resources which must not be
+        included. Each level is fetched with a single query and at most
+        ``max_include_size`` resources are included, in the order they are
+        reached. Dangling linkages are ignored.
+        """
 
-    async def update(self, id, raw):
-        """Update a resource in the DB.
+        max_size = self._config.get('max_include_size', 1000)
+        wide = widen_fields(fields, tree)
+        included = OrderedDict()
+        while pending:
+            missing = [id for id in OrderedDict.fromkeys(
+                       id for (id, _) in pending)
+                       if id not in known and id not in included]
+            if len(included) + len(missing) > max_size:
+                raise BadQueryError(
+                    param='include',
+                    msg='more than %d resources to include' % max_size)
+            for res in await self.read_many(missing, wide):
+                if not isinstance(res, APIError):
+                    included[res['id']] = res
+
+            # a resource already reached can be reached again by another
+            # path, the tree being finite this terminates
+            step = []
+            for (id, subtree) in pending:
+                res = included.get(id) or known.get(id)
+                if res is not None and subtree:
+                    step.extend(self._include_step(res, subtree))
+            pending = step
+
+        for res in included.values():
+            restrict_fields(res, fields)
+        return list(included.values())
+
+    async def update(self, id, raw, render=True, version=None):
+        """Update a resource in the DB and return it's rendered form.
 
         `id` must be an instance of `uuid.UUID`. Raises `NoResourceError` if
         the resource is not found. `raw` must be the content of the request as
         specified by JSON API. See https://jsonapi.org/format/#crud-updating.
+        If `render` is false, nothing is returned. If `version` is given, the
+        resource is only updated if it is at this version (see `_write`).
         """
 
-        schema = self._types[await self.type_by_id(id)]
+        type = await self.type_by_id(id)
+        schema = self._types[type]
         data = await schema.sanitize(raw, is_create=False)
-        if len(data) > 0:
-            await self._db.resources.update_one({'_id': id}, {'$set': data})
+        if len(data) == 0:
+            res = await self.resource_by_id(id)
+            if version is not None and res.get('version', 0) != version:
+                raise VersionMismatchError(id=id, version=version)
+            if not render:
+                return None
+            return await schema.render(res)
 
-    async def delete(self, id):
+        keys = [k[len('body.'):] for k in data]
+        old = await self._old_links(id, type, keys)
+        doc = await self._write(id, {'$set': data},
+                                projection=None if render else {'_id': 1},
+                                version=version)
+        for (key, links) in old.items():
+            new = link_ids(data['body.%s' % key])
+            await self._sync_inverses(id, type, key, added=new - links,
+                                      removed=links - new)
+
+        if render:
+            return await schema.render(doc)
+
+    async def delete(self, id, version=None):
         """Remove a resource from the DB.
 
-        `id` must be an instance of `uuid.UUID`. Raises KeyError if the
-        resource is not found.
+        `id` must be an instance of `uuid.UUID`. Raises `NoResourceError` if
+        the resource is not found. If `version` is given, the resource is only
+        deleted if it is at this version (see `_write`).
         """
 
         logger.debug('Deleting resource {} from the DB'.format(id))
-        result = await self._db.resources.delete_one({'_id': id})
-        if result.deleted_count == 0:
-            raise NoResourceError(id=id)
+        doc = await self._db.resources.find_one_and_delete(
+            version_query(id, version))
+        self._invalidate(id)
+        if doc is None:
+            await self._missed(id, version)
+        self._type_cache.discard(id)
+        for key in self._inverses.get(doc['type'], {}):
+            await self._sync_inverses(id, doc['type'], key,
+                                      removed=link_ids(doc['body'].get(key)))
+        if doc['type'] in self._types:
+            await self._release_uploads(
+                upload_digest(doc['body'].get(key))
+                for (key, model) in self._types[doc['type']].items()
+                if model.is_upload)
+
+        if self._garbage_event is not None:
+            self._garbage.add(id)
+            self._garbage_event.set()
 
     async def item_read(self, id, key):
         schema = self._types[await self.type_by_id(id)]
@@ -135,8 +1100,9 @@ class Store:
         data = await self.resource_by_id(id, {'body.%s' % key: 1})
         return await schema[key].render(id, data['body'].get(key))
 
-    async def item_update(self, id, key, raw):
-        schema = self._types[await self.type_by_id(id)]
+    async def item_update(self, id, key, raw, render=True, version=None):
+        type = await self.type_by_id(id)
+        schema = self._types[type]
 
         try:
             data = await schema[key].sanitize(raw)
@@ -144,27 +1110,397 @@ class Store:
             err.status = 404
             raise err
 
-        await self._db.resources.update_one(
-            {'_id': id},
-            {'$set': {'body.%s' % key: data}})
+        old = await self._old_links(id, type, [key])
+        doc = await self._write(id, {'$set': {'body.%s' % key: data}},
+                                projection={'body.%s' % key: 1},
+                                version=version)
+        if key in old:
+            new = link_ids(data)
+            await self._sync_inverses(id, type, key, added=new - old[key],
+                                      removed=old[key] - new)
+
+        if render:
+            return await schema[key].render(id, doc['body'].get(key))
+
+    async def item_upload(self, id, rel, content_type, content, render=True,
+                          version=None, length=None):
+        """Store the file read from the `StreamReader` `content` as the upload
+        body item `rel` of a resource.
+
+        `length` is the announced size of the file, if known, it is only used
+        to reject files which are too large before reading them.
+        """
 
-    async def item_upload(self, id, rel, content_type, content):
         schema = self._types[await self.type_by_id(id)]
+        max_size = self._upload_limit(schema, rel, content_type, length)
+
+        tmp, size, digest = await self._blobs.write(content, max_size=max_size)
+        url = await self._store_upload(id, rel, tmp, size, digest,
+                                       content_type, version=version)
+
+        if render:
+            return await schema[rel].render(id, url)
+
+    def _upload_limit(self, schema, rel, content_type, length=None):
+        """Check that a file of given content type and `length` (if known)
+        can be uploaded to the item `rel` and return its maximum size."""
 
         if content_type not in schema[rel].acceptable:
             raise NotAcceptableError()
-        blob_id = uuid4()
-        path = os.path.join(tozti.CONFIG['http']['upload_dir'], str(blob_id))
-        with open(path, 'wb') as stream:
-            async for chunk, _ in content.iter_chunks():
-                stream.write(chunk)
+        max_size = schema[rel].max_size
+        if max_size is None:
+            max_size = self._uploads_config.get('max_size') or None
+        if max_size is not None and length is not None and length > max_size:
+            raise UploadTooLargeError(max_size=max_size)
+        return max_size
 
-        await self._db.resources.update_one(
-            {'_id': id},
-            {'$set': {'body.%s' % rel: fmt_upload_url(blob_id)}})
+    async def _store_upload(self, id, rel, tmp, size, digest, content_type,
+                            version=None):
+        """Publish the temporary blob `tmp` and make it the upload item `rel`
+        of a resource. Return its url.
+
+        The reference to the previous file of the item is released.
+        """
+
+        try:
+            await self._acquire_upload(digest, size, content_type)
+        except BaseException:
+            await self._blobs.discard(tmp)
+            raise
+        await self._blobs.publish(tmp, digest)
+
+        url = fmt_upload_url(digest)
+        try:
+            doc = await self._write(id, {'$set': {'body.%s' % rel: url}},
+                                    projection={'body.%s' % rel: 1},
+                                    version=version, before=True)
+        except BaseException:
+            await self._release_uploads([digest])
+            raise
+        await self._release_uploads([upload_digest(doc['body'].get(rel))])
+        return url
+
+    async def create_upload(self, id, rel, content_type, length):
+        """Start a resumable upload of a file of `length` bytes to the upload
+        item `rel` of a resource and return its id.
+
+        The content is then sent in one or several chunks with
+        `upload_append`. Uploads not written for ``uploads.partial_ttl``
+        seconds are abandoned (see `expire_uploads`).
+        """
 
-    async def item_append(self, id, key, raw):
         schema = self._types[await self.type_by_id(id)]
+        if rel not in schema:
+            raise NoItemError(key=rel, status=404)
+        if not schema[rel].is_upload:
+            raise BadItemError('body item {key} is not an upload', key=rel)
+        self._upload_limit(schema, rel, content_type, length)
+
+        upload_id = uuid4()
+        doc = {'_id': upload_id, 'resource': id, 'item': rel,
+               'content-type': content_type, 'length': length, 'offset': 0,
+               'parts': [], 'expires': self._upload_expiration()}
+        if self._blobs.can_append:
+            # the file is written in place instead of by parts
+            doc['blob'] = await self._blobs.create()
+        try:
+            await self._db.partial_uploads.insert_one(doc)
+        except BaseException:
+            await self._discard_parts(doc)
+            raise
+        return upload_id
+
+    def _upload_expiration(self):
+        ttl = self._uploads_config.get('partial_ttl', 86400)
+        return datetime.utcnow().replace(microsecond=0) + timedelta(seconds=ttl)
+
+    async def upload_status(self, upload_id):
+        """Return the offset, length and expiration date of a resumable
+        upload. Raises `NoUploadError` if it does not exist."""
+
+        doc = await self._db.partial_uploads.find_one(
+            {'_id': upload_id, 'expires': {'$gt': datetime.utcnow()}})
+        if doc is None:
+            raise NoUploadError(id=upload_id)
+        return doc['offset'], doc['length'], doc['expires']
+
+    async def _keep_writing(self, upload_id, writer, stream):
+        """Refresh the claim of `writer` on a resumable upload while it
+        reads `stream`.
+
+        If the claim was taken over (the process stalled for more than
+        `WRITE_TIMEOUT`), the stream is stopped before its next chunk: the
+        new writer appends at the same offset.
+        """
+
+        while True:
+            await asyncio.sleep(WRITE_TIMEOUT / 3)
+            res = await self._db.partial_uploads.update_one(
+                {'_id': upload_id, 'writer': writer},
+                {'$set': {'writing': datetime.utcnow()}})
+            if res.matched_count == 0:
+                stream.abort(UploadBusyError(id=upload_id))
+                return
+
+    async def upload_append(self, upload_id, offset, content):
+        """Append the content of a `StreamReader` to a resumable upload.
+
+        `offset` must be the current offset of the upload, otherwise
+        `UploadOffsetError` is raised. Data received before an error (e.g. a
+        lost connection) is kept. Once the whole file is received, it is
+        committed to its upload item like with `item_upload`.
+
+        Return the new offset and the url of the file if it was committed.
+        """
+
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=WRITE_TIMEOUT)
+        writer = uuid4()
+        doc = await self._db.partial_uploads.find_one_and_update(
+            {'_id': upload_id, 'offset': offset, 'expires': {'$gt': now},
+             '$or': [{'writing': {'$exists': False}},
+                     {'writing': {'$lt': stale}}]},
+            {'$set': {'writing': now, 'writer': writer}})
+        if doc is None:
+            doc = await self._db.partial_uploads.find_one(
+                {'_id': upload_id, 'expires': {'$gt': now}})
+            if doc is None:
+                raise NoUploadError(id=upload_id)
+            if doc['offset'] != offset:
+                raise UploadOffsetError(id=upload_id, offset=doc['offset'])
+            raise UploadBusyError(id=upload_id)
+
+        # every request appends to the blob of the upload or, if the storage
+        # cannot do it, adds a part (a temporary blob)
+        stream = ChunkStream(content, doc['length'] - offset)
+        name, size, digest = None, 0, None
+        keeper = asyncio.ensure_future(
+            self._keep_writing(upload_id, writer, stream))
+        try:
+            if 'blob' in doc:
+                size = await self._blobs.append(doc['blob'], stream, offset)
+            else:
+                name, size, digest = await self._blobs.write(stream)
+        finally:
+            keeper.cancel()
+            # release the claim whatever happens, the data received so far
+            # is kept
+            update = {'$set': {'expires': self._upload_expiration()},
+                      '$unset': {'writing': '', 'writer': ''}}
+            if size > 0:
+                update['$inc'] = {'offset': size}
+            if size > 0 and name is not None:
+                update['$push'] = {'parts': {'name': name, 'size': size,
+                                             'digest': digest}}
+            res = await self._db.partial_uploads.update_one(
+                {'_id': upload_id, 'writer': writer}, update)
+            if name is not None and (size == 0 or res.matched_count == 0):
+                await self._blobs.discard(name)
+        if res.matched_count == 0:
+            # the claim was taken over or the upload abandoned meanwhile
+            raise UploadBusyError(id=upload_id)
+        if stream.error is not None:
+            raise stream.error
+
+        offset += size
+        if offset < doc['length']:
+            return offset, None
+
+        # the upload is over whatever happens next
+        doc = await self._db.partial_uploads.find_one_and_delete(
+            {'_id': upload_id})
+        if doc is None:
+            raise NoUploadError(id=upload_id)
+        parts = doc['parts']
+        if 'blob' in doc:
+            name = doc['blob']
+            try:
+                digest = await self._blobs.digest(name)
+            except BaseException:
+                await self._blobs.discard(name)
+                raise
+        elif len(parts) == 1:
+            name, digest = parts[0]['name'], parts[0]['digest']
+        else:
+            try:
+                name, _, digest = await self._blobs.write(
+                    ConcatStream(self._blobs, [p['name'] for p in parts]))
+            finally:
+                for part in parts:
+                    await self._blobs.discard(part['name'])
+        url = await self._store_upload(doc['resource'], doc['item'], name,
+                                       offset, digest, doc['content-type'])
+        return offset, url
+
+    async def delete_upload(self, upload_id):
+        """Abandon a resumable upload."""
+
+        doc = await self._db.partial_uploads.find_one_and_delete(
+            {'_id': upload_id})
+        if doc is None:
+            raise NoUploadError(id=upload_id)
+        await self._discard_parts(doc)
+
+    async def _discard_parts(self, doc):
+        """Remove the temporary blobs of a resumable upload."""
+
+        if 'blob' in doc:
+            await self._blobs.discard(doc['blob'])
+        for part in doc['parts']:
+            await self._blobs.discard(part['name'])
+
+    async def expire_uploads(self, check=False):
+        """Remove the resumable uploads which expired and return their
+        number. If `check` is true, nothing is removed."""
+
+        query = {'expires': {'$lte': datetime.utcnow()}}
+        expired = 0
+        async for doc in self._db.partial_uploads.find(query, {'_id': 1}):
+            expired += 1
+            if check:
+                continue
+            doc = await self._db.partial_uploads.find_one_and_delete(
+                dict(query, _id=doc['_id']))
+            if doc is not None:
+                await self._discard_parts(doc)
+        return expired
+
+    async def upload_info(self, name):
+        """Return the size, the content type and the local path (`None` if
+        the storage is not on the local filesystem) of an uploaded file.
+
+        `name` is the last part of its url. Raises `NoUploadError` if there
+        is no such file.
+        """
+
+        size = None
+        if DIGEST_RE.match(name) or UPLOAD_UUID_RE.match(name):
+            size = await self._blobs.size(name)
+        if size is None:
+            raise NoUploadError(id=name)
+        if DIGEST_RE.match(name):
+            doc = await self._db.uploads.find_one(
+                {'_id': name}, {'content-type': 1})
+            if doc is not None:
+                return size, doc['content-type'], self._blobs.local_path(name)
+        return size, 'application/octet-stream', self._blobs.local_path(name)
+
+    async def read_upload(self, name, start=0, end=None):
+        """Return an asynchronous iterator on the chunks of the bytes `start`
+        to `end` (excluded) of an uploaded file."""
+
+        return await self._blobs.read(name, start, end)
+
+    async def _acquire_upload(self, digest, size, content_type):
+        """Add a reference to the uploaded file with given digest.
+
+        This must be done before the file is published: the sweeper may be
+        removing a previous copy of the same file, in which case this waits
+        for it to finish. Raises `UploadSweepingError` if it takes more than
+        `ACQUIRE_TIMEOUT` seconds.
+        """
+
+        deadline = monotonic() + ACQUIRE_TIMEOUT
+        while True:
+            # a claim becomes stale while we wait
+            now = datetime.utcnow()
+            unclaimed = [{'sweeping': {'$exists': False}},
+                         {'sweeping': {'$lt': now - timedelta(seconds=SWEEP_TIMEOUT)}}]
+            try:
+                await self._db.uploads.update_one(
+                    {'_id': digest, '$or': unclaimed},
+                    {'$inc': {'refs': 1},
+                     '$unset': {'released': '', 'sweeping': ''},
+                     '$setOnInsert': {'size': size,
+                                      'content-type': content_type,
+                                      'created': now}},
+                    upsert=True)
+                return
+            except DuplicateKeyError:
+                # the document exists but is claimed by the sweeper
+                if monotonic() > deadline:
+                    raise UploadSweepingError(digest=digest)
+                await asyncio.sleep(0.1)
+
+    async def _release_uploads(self, digests):
+        """Remove a reference to each of the uploaded files with given
+        digests (`None` are ignored).
+
+        The files no longer referenced are removed later by `sweep_uploads`.
+        """
+
+        counts = Counter(d for d in digests if d is not None)
+        if not counts:
+            return
+        by_count = {}
+        for (digest, n) in counts.items():
+            by_count.setdefault(n, []).append(digest)
+        for (n, group) in by_count.items():
+            await self._db.uploads.update_many(
+                {'_id': {'$in': group}}, {'$inc': {'refs': -n}})
+        await self._db.uploads.update_many(
+            {'_id': {'$in': list(counts)}, 'refs': {'$lte': 0},
+             'released': {'$exists': False}},
+            {'$set': {'released': datetime.utcnow()}})
+
+    async def sweep_uploads(self, delay=0, check=False):
+        """Remove the uploaded files which have not been referenced for
+        `delay` seconds and return their number.
+
+        Each file is first claimed, so that an upload of the same content
+        waits until it is removed (see `_acquire_upload`). If `check` is
+        true, nothing is removed.
+        """
+
+        now = datetime.utcnow()
+        query = {'refs': {'$lte': 0},
+                 'released': {'$lt': now - timedelta(seconds=delay)}}
+        unclaimed = [{'sweeping': {'$exists': False}},
+                     {'sweeping': {'$lt': now - timedelta(seconds=SWEEP_TIMEOUT)}}]
+        removed = 0
+        async for upload in self._db.uploads.find(query, {'_id': 1}):
+            digest = upload['_id']
+            if check:
+                removed += 1
+                continue
+            claim = dict(query, _id=digest)
+            claim['$or'] = unclaimed
+            claimed = await self._db.uploads.find_one_and_update(
+                claim, {'$set': {'sweeping': now}}, projection={'_id': 1})
+            if claimed is None:
+                # referenced again in the meantime
+                continue
+            await self._blobs.remove(digest)
+            await self._db.uploads.delete_one({'_id': digest, 'sweeping': now})
+            removed += 1
+        return removed
+
+    async def _sweep_uploads(self):
+        """Remove the unreferenced uploaded files and the expired resumable
+        uploads in the background, every ``uploads.sweep_interval`` seconds.
+
+        Files are kept ``uploads.sweep_delay`` seconds after their last
+        reference is removed, so that recently served urls remain valid for
+        a while.
+        """
+
+        interval = self._uploads_config.get('sweep_interval', 600)
+        delay = self._uploads_config.get('sweep_delay', 3600)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.sweep_uploads(delay)
+                expired = await self.expire_uploads()
+                if removed + expired > 0:
+                    logger.debug('Removed {} unreferenced uploads and {} '
+                                 'expired partial uploads'
+                                 .format(removed, expired))
+            except Exception as err:
+                logger.error('Could not sweep uploads: {}'.format(err))
+
+    async def item_append(self, id, key, raw, render=True, version=None):
+        type = await self.type_by_id(id)
+        schema = self._types[type]
 
         if key not in schema:
             raise NoItemError(key=key, status=404)
@@ -174,12 +1510,18 @@ class Store:
 
         data = await schema[key].sanitize(raw)
 
-        await self._db.resources.update_one(
-            {'_id': id},
-            {'$addToSet': {'body.%s' % key: {'$each': data}}})
+        doc = await self._write(
+            id, {'$addToSet': {'body.%s' % key: {'$each': data}}},
+            projection={'body.%s' % key: 1}, version=version)
+        if key in self._inverses.get(type, {}):
+            await self._sync_inverses(id, type, key, added=link_ids(data))
 
-    async def item_remove(self, id, key, raw):
-        schema = self._types[await self.type_by_id(id)]
+        if render:
+            return await schema[key].render(id, doc['body'].get(key))
+
+    async def item_remove(self, id, key, raw, render=True, version=None):
+        type = await self.type_by_id(id)
+        schema = self._types[type]
 
         if key not in schema:
             raise NoItemError(key=key, status=404)
@@ -188,32 +1530,183 @@ class Store:
             raise BadItemError('body item {key} is not an array', key=key)
 
         data = await schema[key].sanitize(raw, check_consistency=False)
-        print(data)
+        removed = link_ids(data)
+
+        doc = await self._write(
+            id, {'$pull': {'body.%s' % key: {'id': {'$in': list(removed)}}}},
+            projection={'body.%s' % key: 1}, version=version)
+        await self._sync_inverses(id, type, key, removed=removed)
+
+        if render:
+            return await schema[key].render(id, doc['body'].get(key))
+
+    async def resources_by_type(self, type, size=None, after=None, sort=None):
+        """Return a page of linkages to the resources of a given type.
+
+        See `type_page` for the arguments. Returns the linkages and the cursor
+        of the next page, which is `None` on the last page.
+        """
 
-        await self._db.resources.update_one(
-            {'_id': id},
-            {'$pull': {'body.%s' % key: {'id': {'$in': [UUID(x['id']) for x in data]}}}})
+        page = self.type_page(type, size=size, after=after, sort=sort)
+        links = []
+        async for link in page:
+            links.append(link)
+        return links, page.next
+
+    def type_page(self, type, size=None, after=None, sort=None, fields=None,
+                  filters=None):
+        """Return a `ResourcePage` over the resources of a given type.
+
+        Resources are ordered by `sort` (one of `SORT_KEYS`, prefixed with
+        ``-`` for descending order) then by id, or only by id if `sort` is
+        `None`. At most `size` linkages are returned (defaults to the
+        ``page_size`` option), starting after the position given by the
+        cursor `after`. If `fields` is given (a set of body items), the
+        resources are rendered with only these items instead of linkages.
+
+        Only the resources matching `filters` are listed, see
+        `Schema.filter_query`. If none of the filtered items is indexed, a
+        warning is logged or, if the ``unindexed_filters`` option is
+        ``"reject"``, `BadQueryError` is raised.
+        """
 
-    async def resources_by_type(self, type):
         logger.debug('Querying type %s' % type)
         if type not in self._types:
             raise NoTypeError(type=type, status=404)
 
-        cursor = self._db.resources.find({'type': type}, ['_id'])
-        links = []
-        async for hit in cursor:
-            links.append({'id': hit['_id'],
-                          'type': type,
-                          'href': fmt_resource_url(hit['_id'])})
-        return links
+        max_size = self._config.get('max_page_size', 1000)
+        if size is None:
+            size = self._config.get('page_size', 100)
+        if not 0 < size <= max_size:
+            raise BadQueryError(param='page[size]',
+                                msg='must be between 1 and %d' % max_size)
+
+        key = None
+        order = ASCENDING
+        if sort is not None:
+            key = sort[1:] if sort.startswith('-') else sort
+            order = DESCENDING if sort.startswith('-') else ASCENDING
+            if key not in SORT_KEYS:
+                raise BadQueryError(param='sort', msg='cannot sort by %s' % key)
+
+        query = {'type': type}
+        if filters:
+            query = self._types[type].filter_query(filters)
+            self._check_indexed(type, [k for k in query if k != 'type'])
+        if after is not None:
+            op = '$gt' if order == ASCENDING else '$lt'
+            try:
+                if key is None:
+                    query['_id'] = {op: UUID(after)}
+                else:
+                    (value, last) = after.split(',')
+                    value, last = parse_date(value), UUID(last)
+                    query['$or'] = [{key: {op: value}},
+                                    {key: value, '_id': {op: last}}]
+            except ValueError:
+                raise BadQueryError(param='page[after]', msg='bad cursor')
+
+        if key is None:
+            order_by = [('_id', order)]
+        else:
+            order_by = [(key, order), ('_id', order)]
+
+        # fetch one more resource to know if there is a next page
+        if fields is None:
+            projection = [k for (k, _) in order_by]
+        else:
+            projection = fields_projection(fields)
+        cursor = self._db.resources.find(query, projection)
+        cursor.sort(order_by).limit(size + 1)
+        return ResourcePage(cursor, type, size, key, self._types[type], fields)
+
+    def _check_indexed(self, type, keys):
+        """Check that a query on some `keys` of the resources of `type` can
+        use an index."""
+
+        if any(key in self._indexed_keys for key in keys):
+            return
+        msg = 'no index on %s for %s' % (', '.join(sorted(keys)), type)
+        if self._config.get('unindexed_filters', 'warn') == 'reject':
+            raise BadQueryError(param='filter', msg=msg)
+        # warn only once for each query shape
+        if msg not in self._unindexed:
+            self._unindexed.add(msg)
+            logger.warning('Unindexed filter: %s' % msg)
+
+    async def auto_targets(self, id, key):
+        """Return an asynchronous iterator over the linkages of an `auto`
+        relationship which is queried on every read.
+
+        Returns `None` if the body item is not such a relationship.
+        """
+
+        schema = self._types[await self.type_by_id(id)]
+        if key not in schema:
+            raise NoItemError(key=key, status=404)
+        model = schema[key]
+        if getattr(model, 'arity', None) != 'auto' or model.materialized:
+            return None
+        return model.targets(id)
+
+    def _cache_handle(self, handle, doc, generation):
+        """Cache the resolution of a handle, `doc` being the handle document
+        or `None` if it does not exist."""
 
-    async def by_handle(self, handle):
-        doc = await self._db.handles.find_one({'_id': handle})
         if doc is None:
+            self._handle_cache.put(handle, NO_HANDLE, generation,
+                                   ttl=self._handle_negative_ttl)
+        else:
+            self._handle_cache.put(handle, (doc['target'], doc['type']),
+                                   generation)
+
+    async def by_handle(self, handle):
+        """Return the linkage to the resource with given handle.
+
+        Resolutions, including the unknown handles, are cached. Raises
+        `NoHandleError` if the handle does not exist.
+        """
+
+        target = self._handle_cache.get(handle, UNKNOWN)
+        if target is UNKNOWN:
+            generation = self._handle_cache.generation
+            doc = await self._db.handles.find_one({'_id': handle})
+            self._cache_handle(handle, doc, generation)
+            target = NO_HANDLE if doc is None else (doc['target'], doc['type'])
+
+        if target is NO_HANDLE:
             raise NoHandleError(handle=handle)
-        return {'id': doc['target'],
-                'type': doc['type'],
-                'href': fmt_resource_url(doc['target'])}
+        return {'id': target[0],
+                'type': target[1],
+                'href': fmt_resource_url(target[0])}
+
+    async def by_handles(self, handles):
+        """Resolve several handles with a single query.
+
+        Returns a dictionary mapping the handles which exist to linkages (see
+        `by_handle`).
+        """
+
+        targets = {}
+        missing = []
+        for handle in set(handles):
+            target = self._handle_cache.get(handle, UNKNOWN)
+            if target is UNKNOWN:
+                missing.append(handle)
+            elif target is not NO_HANDLE:
+                targets[handle] = target
+
+        if len(missing) > 0:
+            generation = self._handle_cache.generation
+            docs = {}
+            async for doc in self._db.handles.find({'_id': {'$in': missing}}):
+                docs[doc['_id']] = doc
+                targets[doc['_id']] = (doc['target'], doc['type'])
+            for handle in missing:
+                self._cache_handle(handle, docs.get(handle), generation)
+
+        return {handle: {'id': id, 'type': type, 'href': fmt_resource_url(id)}
+                for (handle, (id, type)) in targets.items()}
 
     async def handle_set(self, handle, raw, allow_overwrite):
         try:
@@ -222,24 +1715,47 @@ class Store:
             id = UUID(raw['data']['id'])
         except:
             raise BadDataError()
-        
-        if not allow_overwrite and (await self._db.handles.find({'_id': handle}).count()) > 0:
-            raise HandleExistsError(handle)
-        await self.handle_set_id(handle, id)
 
-    async def handle_set_id(self, handle, id):
+        await self.handle_set_id(handle, id, overwrite=allow_overwrite)
+
+    async def handle_set_id(self, handle, id, overwrite=True):
+        """Make `handle` point to the resource `id`.
+
+        If `overwrite` is false, the handle is created with a single insert
+        and `HandleExistsError` is raised if it already exists.
+        """
+
         type = await self.type_by_id(id)
-        await self._db.handles.update_one(
-            {'_id': handle},
-            {'$set': {'target':id, 'type':type}},
-            upsert=True)
+        if overwrite:
+            await self._db.handles.update_one(
+                {'_id': handle},
+                {'$set': {'target': id, 'type': type}},
+                upsert=True)
+        else:
+            try:
+                await self._db.handles.insert_one(
+                    {'_id': handle, 'target': id, 'type': type})
+            except DuplicateKeyError:
+                # drop a stale negative entry
+                self._handle_cache.invalidate(handle)
+                raise HandleExistsError(handle=handle)
+        self._handle_cache.invalidate(handle)
 
     async def handle_delete(self, handle):
         res = await self._db.handles.delete_one({'_id': handle})
+        self._handle_cache.invalidate(handle)
         if res.deleted_count == 0:
             raise NoHandleError(handle=handle)
 
     async def close(self):
         """Close the connection to the MongoDB server."""
 
+        for task in self._tasks:
+            task.cancel()
+        if self._garbage:
+            logger.warning('{} deleted resources may still be referenced'
+                           .format(len(self._garbage)))
+        logger.info('Resource cache: {}'.format(self._cache.stats()))
+        logger.info('Handle cache: {}'.format(self._handle_cache.stats()))
+        self._upload_executor.shutdown(wait=False)
         self._client.close()
@@ -0,0 +1,229 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Request-scoped loading of resources.
+
+Every request handled by the server gets a `ResourceLoader` (see
+`loader_middleware`), which the store uses whenever it looks a resource up
+by id. The loader of the request being handled is found from the current
+task: tasks working for a request must be started with `spawn` to share it.
+"""
+
+
+import asyncio
+import weakref
+from collections import OrderedDict
+
+from aiohttp import web
+
+
+# task -> loader of the request it works for
+_LOADERS = weakref.WeakKeyDictionary()
+
+
+def _current_task():
+    if hasattr(asyncio, 'current_task'):
+        return asyncio.current_task()
+    return asyncio.Task.current_task()
+
+
+def current_loader():
+    """Return the loader of the request handled by the current task, or
+    `None` outside of a request (e.g. in commands)."""
+
+    task = _current_task()
+    return _LOADERS.get(task) if task is not None else None
+
+
+def spawn(coro):
+    """Schedule a coroutine in a new task sharing the loader of the current
+    one."""
+
+    task = asyncio.ensure_future(coro)
+    loader = current_loader()
+    if loader is not None:
+        _LOADERS[task] = loader
+    return task
+
+
+async def run_concurrently(coros):
+    """Run coroutines in tasks started with `spawn` and return their results.
+
+    If one of them fails the others are cancelled. A single coroutine is
+    simply awaited.
+    """
+
+    coros = list(coros)
+    if len(coros) <= 1:
+        results = []
+        for coro in coros:
+            results.append(await coro)
+        return results
+
+    tasks = [spawn(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+class ResourceLoader:
+    """Batch loader and identity map of raw resources for one request.
+
+    Resources asked for with the same projection while the same iteration
+    of the event loop runs are fetched together with
+    `Store._resources_by_id`, which reads the shared cache first and then
+    the database with a single ``$in`` query. The documents are then kept
+    until the end of the request, missing resources included, so that each
+    resource is fetched at most once for a given projection. Whole
+    documents also answer the lookups with a projection. At most `size`
+    documents are kept, the least recently used are dropped first.
+
+    The store calls :meth:`forget` when it writes a resource.
+    """
+
+    def __init__(self, store, size=1000):
+        self._store = store
+        self.size = size
+        # (projection key, id) -> document, or None if it does not exist
+        self._docs = OrderedDict()
+        # (projection key, id) -> future of the batch fetching it
+        self._loading = {}
+        # projection key -> (future, ids) of the batch collected during
+        # this iteration
+        self._next = {}
+        self._generation = 0
+
+    async def load(self, id, projection=None):
+        """Return the raw resource with given id or `None` if it does not
+        exist."""
+
+        return (await self.load_many([id], projection)).get(id)
+
+    async def load_many(self, ids, projection=None):
+        """Return a dictionary mapping resource ids to raw resources.
+
+        Resources which are not found are missing from the result.
+        """
+
+        key = projection_key(projection)
+        found = {}
+        batches = OrderedDict()
+        for id in set(ids):
+            for entry in ((None, id), (key, id)):
+                if entry in self._docs:
+                    self._docs.move_to_end(entry)
+                    if self._docs[entry] is not None:
+                        found[id] = self._docs[entry]
+                    break
+            else:
+                future = (self._loading.get((None, id))
+                          or self._loading.get((key, id))
+                          or self._schedule(key, projection, id))
+                batches.setdefault(future, []).append(id)
+        if len(batches) == 0:
+            return found
+
+        # one of the requesters being cancelled must not cancel the batch
+        results = await asyncio.gather(
+            *(asyncio.shield(future) for future in batches))
+        for (ids, docs) in zip(batches.values(), results):
+            found.update((id, docs[id]) for id in ids if id in docs)
+        return found
+
+    def forget(self, *ids):
+        """Drop resources which were written, including the lookups already
+        running: they may read the resources as they were before."""
+
+        self._generation += 1
+        ids = set(ids)
+        for entries in (self._docs, self._loading):
+            for entry in [e for e in entries if e[1] in ids]:
+                del entries[entry]
+
+    def _schedule(self, key, projection, id):
+        """Add a resource to the batch of this iteration and return the
+        future of the batch."""
+
+        if key not in self._next:
+            loop = asyncio.get_event_loop()
+            self._next[key] = (loop.create_future(), set())
+            loop.call_soon(self._dispatch, key, projection)
+        (future, ids) = self._next[key]
+        ids.add(id)
+        self._loading[(key, id)] = future
+        return future
+
+    def _dispatch(self, key, projection):
+        (future, ids) = self._next.pop(key)
+        asyncio.ensure_future(self._fetch(future, key, projection, ids))
+
+    async def _fetch(self, future, key, projection, ids):
+        generation = self._generation
+        try:
+            docs = await self._store._resources_by_id(ids, projection)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            # the requesters may all have been cancelled
+            future.exception()
+        else:
+            # what was read before a write is not kept
+            if generation == self._generation:
+                for id in ids:
+                    self._docs[(key, id)] = docs.get(id)
+                    self._docs.move_to_end((key, id))
+                while len(self._docs) > self.size:
+                    self._docs.popitem(last=False)
+            future.set_result(docs)
+        finally:
+            for id in ids:
+                if self._loading.get((key, id)) is future:
+                    del self._loading[(key, id)]
+
+
+def projection_key(projection):
+    """Return a hashable key for a MongoDB projection (`None` for whole
+    documents)."""
+
+    if projection is None:
+        return None
+    return tuple(sorted(projection.items()))
+
+
+@web.middleware
+async def loader_middleware(req, handler):
+    """Give its own `ResourceLoader` to every request, as
+    ``req['tozti-loader']``."""
+
+    store = req.app.get('tozti-store')
+    if store is None:
+        return await handler(req)
+
+    loader = store.request_loader()
+    req['tozti-loader'] = loader
+    task = _current_task()
+    _LOADERS[task] = loader
+    try:
+        return await handler(req)
+    finally:
+        _LOADERS.pop(task, None)
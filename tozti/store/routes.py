@@ -16,12 +16,21 @@
 # along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 from json import JSONDecodeError
+import os
+import re
 from uuid import UUID
 
+from aiohttp import web
+from aiohttp.http_exceptions import LineTooLong
+
 import tozti
-from tozti.utils import RouterDef, NotJsonError, BadJsonError, json_response
-from tozti.store import logger
+from tozti.utils import (RouterDef, NotJsonError, BadJsonError, BadDataError,
+                         APIError, json_response, stream_json_response,
+                         http_date, not_modified, parse_range,
+                         NotAcceptableError)
+from tozti.store import logger, BadQueryError, NoHandleError, VersionMismatchError, BadHeaderError
 
 
 # Regex of an UUID as hexdigit string
@@ -30,12 +39,20 @@ UUID_RE = '-'.join('[0-9a-fA-F]{%d}' % i for i in (8, 4, 4, 4, 12))
 # Here, valid type names are arbitrary alphanumeric strings
 # with '-', '_' and at most one '/'
 TYPE_RE = '([\w-]+/)?[\w-]+'
+# Regex of an entity tag sent in If-Match, see `fmt_etag`
+ETAG_RE = re.compile(r'^"(\d+)"$')
+# Regex of a filter query parameter: filter[item] or filter[item][operator]
+FILTER_RE = re.compile(r'^filter\[([^\]]+)\](?:\[(\w+)\])?$')
 
 
 router = RouterDef()
 resources = router.add_route('/resources')
+resources_bulk = router.add_route('/resources/bulk')
 resources_single = router.add_route('/resources/{id:%s}' % UUID_RE)
 relationship = router.add_route('/resources/{id:%s}/{rel}' % UUID_RE)
+item_uploads = router.add_route('/resources/{id:%s}/{rel}/uploads' % UUID_RE)
+upload = router.add_route('/uploads/{id:%s}' % UUID_RE)
+fetch = router.add_route('/fetch')
 types = router.add_route('/by-type/{type:%s}' % TYPE_RE)
 by_handle = router.add_route('/by-handle/{handle}')
 
@@ -50,6 +67,119 @@ async def get_json_from_request(req):
     return data
 
 
+def prefers_minimal(req):
+    """Check if the client sent ``Prefer: return=minimal`` (RFC 7240)."""
+
+    for header in req.headers.getall('Prefer', ()):
+        for pref in header.split(','):
+            if pref.split(';')[0].strip().lower() == 'return=minimal':
+                return True
+    return False
+
+
+def include_tree(req):
+    """Parse the ``include`` query parameter, see `Store.include_paths`.
+
+    Returns `None` if the parameter is absent.
+    """
+
+    value = req.query.get('include')
+    if value is None:
+        return None
+    return req.app['tozti-store'].include_paths(value)
+
+
+def sparse_fields(req):
+    """Parse the ``fields[type]`` query parameters, see `Store.fieldsets`.
+
+    Returns `None` if there are none.
+    """
+
+    params = {key[len('fields['):-1]: value
+              for (key, value) in req.query.items()
+              if key.startswith('fields[') and key.endswith(']')}
+    if not params:
+        return None
+    return req.app['tozti-store'].fieldsets(params)
+
+
+def filter_params(req):
+    """Parse the ``filter[item][operator]`` query parameters.
+
+    Returns a dictionary mapping items to dictionaries from operators to
+    values (see `Schema.filter_query`). ``filter[item]`` stands for
+    ``filter[item][eq]``.
+    """
+
+    filters = {}
+    for (key, value) in req.query.items():
+        match = FILTER_RE.match(key)
+        if match is not None:
+            (item, op) = match.groups()
+            filters.setdefault(item, {})[op or 'eq'] = value
+    return filters
+
+
+def fmt_etag(version):
+    """Entity tag of a given version of a resource."""
+
+    return '"%d"' % version
+
+
+def set_validators(resp, version, last_modified):
+    """Add the ``ETag`` and ``Last-Modified`` headers to a response."""
+
+    resp.headers['ETag'] = fmt_etag(version)
+    resp.headers['Last-Modified'] = http_date(last_modified)
+    return resp
+
+
+def if_match(req, id):
+    """Return the version of the resource `id` required by the ``If-Match``
+    header of a request.
+
+    Returns `None` if there is no such header or if it is ``*``. Only a
+    single entity tag is supported, with strong comparison: other values
+    never match and raise `VersionMismatchError`.
+    """
+
+    header = req.headers.get('If-Match')
+    if header is None or header.strip() == '*':
+        return None
+    match = ETAG_RE.match(header.strip())
+    if match is None:
+        raise VersionMismatchError(id=id, version=header)
+    return int(match.group(1))
+
+
+def int_header(req, name):
+    """Return the value of a header which must be a non-negative integer."""
+
+    value = req.headers.get(name)
+    if value is None:
+        raise BadHeaderError(header=name, msg='it is missing')
+    try:
+        number = int(value)
+        if number < 0:
+            raise ValueError()
+    except ValueError:
+        raise BadHeaderError(header=name,
+                             msg='%s is not a non-negative integer' % value)
+    return number
+
+
+def fmt_partial_upload_url(id):
+    return 'http://%s/api/store/uploads/%s' % (
+        tozti.CONFIG['http']['hostname'], id)
+
+
+def minimal_response():
+    """Empty response for requests with ``Prefer: return=minimal``."""
+
+    return web.Response(status=204,
+                        headers={'Preference-Applied': 'return=minimal'})
+
+
 @resources.post
 async def resources_post(req):
     """Request handler for ``POST /api/store/resources``."""
@@ -59,12 +189,105 @@ async def resources_post(req):
     return json_response({'data': resource})
 
 
+async def create_batch(store, batch):
+    """Create a batch of resources, `batch` may already contain errors."""
+
+    created = iter(await store.create_many(
+        [raw for raw in batch if not isinstance(raw, APIError)]))
+    results = []
+    for raw in batch:
+        res = raw if isinstance(raw, APIError) else next(created)
+        if isinstance(res, APIError):
+            res = {'errors': [res.to_dict()]}
+        results.append(res)
+    return results
+
+
+@resources_bulk.post
+async def resources_bulk_post(req):
+    """Request handler for ``POST /api/store/resources/bulk``.
+
+    The body is either a JSON API document whose `data` is an array of
+    resource objects or, with the ``application/x-ndjson`` content type, one
+    resource object per line. Resources are created by batches while the
+    body is read.
+    """
+
+    store = req.app['tozti-store']
+    batch_size = tozti.CONFIG.get('store', {}).get('bulk_batch_size', 500)
+    results = []
+
+    if req.content_type == 'application/x-ndjson':
+        batch = []
+        lines = req.content.__aiter__()
+        number = 0
+        while True:
+            try:
+                line = await lines.__anext__()
+            except StopAsyncIteration:
+                break
+            except (ValueError, LineTooLong):
+                # the line is longer than the buffer of the stream, the rest
+                # of the body cannot be split into lines: the results of the
+                # previous lines are returned so that the client can resume
+                results.extend(await create_batch(store, batch))
+                err = BadJsonError('line {line} is too long, the following '
+                                   'lines were not read', status=413,
+                                   line=number + 1)
+                results.append({'errors': [err.to_dict()]})
+                return json_response({'data': results}, status=413)
+            number += 1
+            if len(line.strip()) == 0:
+                continue
+            try:
+                batch.append({'data': json.loads(line.decode('utf-8'))})
+            except ValueError:
+                batch.append(BadJsonError())
+            if len(batch) >= batch_size:
+                results.extend(await create_batch(store, batch))
+                batch = []
+        results.extend(await create_batch(store, batch))
+
+    else:
+        data = await get_json_from_request(req)
+        if not isinstance(data, dict) or not isinstance(data.get('data'), list):
+            raise BadDataError('data must be an array of resource objects')
+        items = [{'data': item} for item in data['data']]
+        for i in range(0, len(items), batch_size):
+            results.extend(await create_batch(store, items[i:i+batch_size]))
+
+    return json_response({'data': results})
+
+
 @resources_single.get
 async def resources_get(req):
     """Request handler for ``GET /api/store/resources/{id}``."""
 
+    from tozti.store.engine import widen_fields
+
     id = UUID(req.match_info['id'])
-    return json_response({'data': await req.app['tozti-store'].read(id)})
+    store = req.app['tozti-store']
+    tree = include_tree(req)
+    fields = sparse_fields(req)
+
+    # included resources have their own versions, compound documents have
+    # no validators
+    validators = None
+    if tree is None:
+        validators = await store.validators(id, fields=fields)
+        if validators is not None and not_modified(
+                req, fmt_etag(validators[0]), validators[1]):
+            return set_validators(web.Response(status=304), *validators)
+
+    resource = await store.read(id, widen_fields(fields, tree))
+    if tree is None:
+        resp = json_response({'data': resource})
+        if validators is not None:
+            set_validators(resp, resource['meta']['version'],
+                           resource['meta']['last-modified'])
+        return resp
+    included = await store.included([resource], tree, fields)
+    return json_response({'data': resource, 'included': included})
 
 
 @resources_single.patch
@@ -73,8 +296,15 @@ async def resources_patch(req):
 
     data = await get_json_from_request(req)
     id = UUID(req.match_info['id'])
-    await req.app['tozti-store'].update(id, data)
-    return json_response({'data': await req.app['tozti-store'].read(id)})
+    store = req.app['tozti-store']
+    version = if_match(req, id)
+    if prefers_minimal(req):
+        await store.update(id, data, render=False, version=version)
+        return minimal_response()
+    resource = await store.update(id, data, version=version)
+    return set_validators(json_response({'data': resource}),
+                          resource['meta']['version'],
+                          resource['meta']['last-modified'])
 
 
 @resources_single.delete
@@ -82,7 +312,7 @@ async def resources_delete(req):
     """Request handler for ``DELETE /api/store/resources/{id}``."""
 
     id = UUID(req.match_info['id'])
-    await req.app['tozti-store'].delete(id)
+    await req.app['tozti-store'].delete(id, version=if_match(req, id))
     return json_response({})
 
 
@@ -90,9 +320,43 @@ async def resources_delete(req):
 async def relationship_get(req):
     """Request handler for ``GET /api/store/resources/{id}/{rel}``."""
 
+    from tozti.store.schema import fmt_relationship_url
+
     id = UUID(req.match_info['id'])
     rel = req.match_info['rel']
-    return json_response({'data': await req.app['tozti-store'].item_read(id, rel)})
+    store = req.app['tozti-store']
+
+    # as for JSON API relationship links, include paths start at the owner
+    tree = include_tree(req)
+    if tree is not None and list(tree) != [rel]:
+        raise BadQueryError(param='include',
+                            msg='every path must start with %s' % rel)
+
+    targets = await store.auto_targets(id, rel)
+    if targets is None and tree is None:
+        # the relationship is stored with the resource, use its validators
+        validators = await store.validators(id, key=rel)
+        if not_modified(req, fmt_etag(validators[0]), validators[1]):
+            return set_validators(web.Response(status=304), *validators)
+        data = await store.item_read(id, rel)
+        return set_validators(json_response({'data': data}), *validators)
+
+    if targets is None:
+        data = await store.item_read(id, rel)
+    elif tree is None:
+        return await stream_json_response(
+            req, targets, path=('data', 'data'),
+            meta=lambda: {'self': fmt_relationship_url(id, rel)})
+    else:
+        links = []
+        async for link in targets:
+            links.append(link)
+        data = {'self': fmt_relationship_url(id, rel), 'data': links}
+
+    return json_response({
+        'data': data,
+        'included': await store.item_included(id, rel, data, tree[rel],
+                                              sparse_fields(req))})
 
 
 @relationship.put
@@ -107,13 +371,84 @@ async def relationship_put(req):
     type_name = await store.type_by_id(id)
     schema = store._types[type_name]
 
+    render = not prefers_minimal(req)
+    version = if_match(req, id)
     if rel in schema and schema[rel].is_upload:
-        await store.item_upload(id, rel, req.content_type, req.content)
+        item = await store.item_upload(id, rel, req.content_type, req.content,
+                                       render=render, version=version,
+                                       length=req.content_length)
 
     else:
         data = await get_json_from_request(req)
-        await store.item_update(id, rel, data)
-    return json_response({'data': await req.app['tozti-store'].item_read(id, rel)})
+        item = await store.item_update(id, rel, data, render=render,
+                                       version=version)
+
+    if not render:
+        return minimal_response()
+    return json_response({'data': item})
+
+
+@item_uploads.post
+async def item_uploads_post(req):
+    """Request handler for ``POST /api/store/resources/{id}/{rel}/uploads``.
+
+    Starts a resumable upload to an upload item, see `upload_patch`.
+    """
+
+    id = UUID(req.match_info['id'])
+    rel = req.match_info['rel']
+    length = int_header(req, 'Upload-Length')
+    content_type = req.headers.get('Upload-Content-Type')
+    if content_type is None:
+        raise BadHeaderError(header='Upload-Content-Type', msg='it is missing')
+
+    store = req.app['tozti-store']
+    upload_id = await store.create_upload(id, rel, content_type, length)
+    return web.Response(status=201, headers={
+        'Location': fmt_partial_upload_url(upload_id),
+        'Upload-Offset': '0'})
+
+
+@upload.head
+async def upload_head(req):
+    """Request handler for ``HEAD /api/store/uploads/{id}``."""
+
+    store = req.app['tozti-store']
+    offset, length, expires = await store.upload_status(
+        UUID(req.match_info['id']))
+    return web.Response(headers={
+        'Upload-Offset': str(offset), 'Upload-Length': str(length),
+        'Upload-Expires': http_date(expires), 'Cache-Control': 'no-store'})
+
+
+@upload.patch
+async def upload_patch(req):
+    """Request handler for ``PATCH /api/store/uploads/{id}``.
+
+    Appends the body of the request, which must start at the current offset
+    of the upload. The file is committed to its item once complete.
+    """
+
+    if req.content_type != 'application/offset+octet-stream':
+        raise NotAcceptableError()
+    offset = int_header(req, 'Upload-Offset')
+
+    store = req.app['tozti-store']
+    offset, url = await store.upload_append(UUID(req.match_info['id']),
+                                            offset, req.content)
+    headers = {'Upload-Offset': str(offset)}
+    if url is not None:
+        headers['Content-Location'] = url
+    return web.Response(status=204, headers=headers)
+
+
+@upload.delete
+async def upload_delete(req):
+    """Request handler for ``DELETE /api/store/uploads/{id}``."""
+
+    store = req.app['tozti-store']
+    await store.delete_upload(UUID(req.match_info['id']))
+    return web.Response(status=204)
 
 
 @relationship.post
@@ -124,8 +459,13 @@ async def relationship_post(req):
     id = UUID(req.match_info['id'])
     rel = req.match_info['rel']
 
-    await req.app['tozti-store'].item_append(id, rel, data)
-    return json_response({'data': await req.app['tozti-store'].item_read(id, rel)})
+    store = req.app['tozti-store']
+    version = if_match(req, id)
+    if prefers_minimal(req):
+        await store.item_append(id, rel, data, render=False, version=version)
+        return minimal_response()
+    return json_response(
+        {'data': await store.item_append(id, rel, data, version=version)})
 
 
 @relationship.delete
@@ -136,16 +476,108 @@ async def relationship_delete(req):
     id = UUID(req.match_info['id'])
     rel = req.match_info['rel']
 
-    await req.app['tozti-store'].item_remove(id, rel, data)
-    return json_response({'data': await req.app['tozti-store'].item_read(id, rel)})
+    store = req.app['tozti-store']
+    version = if_match(req, id)
+    if prefers_minimal(req):
+        await store.item_remove(id, rel, data, render=False, version=version)
+        return minimal_response()
+    return json_response(
+        {'data': await store.item_remove(id, rel, data, version=version)})
+
+
+@fetch.post
+async def fetch_post(req):
+    """Request handler for ``POST /api/store/fetch``.
+
+    The `data` entry of the body is an array of identifiers: objects with
+    either an `id` or a `handle` entry. The response contains, in the same
+    order, the resources or the errors.
+    """
+
+    data = await get_json_from_request(req)
+    if not isinstance(data, dict) or not isinstance(data.get('data'), list):
+        raise BadDataError('data must be an array of identifiers')
+
+    store = req.app['tozti-store']
+    # every item is resolved to an id or an error
+    items = []
+    for ident in data['data']:
+        try:
+            if 'id' in ident:
+                items.append(UUID(ident['id']))
+            else:
+                items.append(str(ident['handle']))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            items.append(BadDataError('invalid identifier: {ident}',
+                                      ident=json.dumps(ident)))
+
+    handles = await store.by_handles(x for x in items if isinstance(x, str))
+    for (i, item) in enumerate(items):
+        if isinstance(item, str):
+            if item in handles:
+                items[i] = handles[item]['id']
+            else:
+                items[i] = NoHandleError(handle=item)
+
+    ids = [x for x in items if isinstance(x, UUID)]
+    resources = iter(await store.read_many(ids, sparse_fields(req)))
+    results = []
+    for item in items:
+        res = next(resources) if isinstance(item, UUID) else item
+        if isinstance(res, APIError):
+            res = {'errors': [res.to_dict()]}
+        results.append(res)
+    return json_response({'data': results})
 
 
 @types.get
 async def types_get(req):
     """Request handler for ``GET /api/store/by-type/{type}``."""
 
+    from tozti.store.engine import widen_fields
+
     type = req.match_info['type']
-    return json_response({'data': await req.app['tozti-store'].resources_by_type(type)})
+    size = req.query.get('page[size]')
+    if size is not None:
+        try:
+            size = int(size)
+        except ValueError:
+            raise BadQueryError(param='page[size]', msg='not an integer')
+
+    store = req.app['tozti-store']
+    tree = include_tree(req)
+    fields = sparse_fields(req)
+    # with a fieldset for the listed type, resources are listed instead of
+    # linkages
+    listed = widen_fields(fields, tree).get(type) if fields else None
+    page = store.type_page(
+        type, size=size, after=req.query.get('page[after]'),
+        sort=req.query.get('sort'), fields=listed,
+        filters=filter_params(req))
+
+    def links():
+        next = None
+        if page.next is not None:
+            query = dict(req.query)
+            query['page[after]'] = page.next
+            next = 'http://%s%s' % (tozti.CONFIG['http']['hostname'],
+                                    req.rel_url.with_query(query))
+        return {'links': {'next': next}}
+
+    if tree is None:
+        return await stream_json_response(req, page, meta=links)
+
+    # the page is bounded, buffer it so that errors can still be reported
+    data = []
+    async for link in page:
+        data.append(link)
+    if listed is None:
+        included = await store.included_links(data, tree, fields)
+    else:
+        included = await store.included(data, tree, fields)
+    resp = {'data': data, 'included': included}
+    resp.update(links())
+    return json_response(resp)
 
 
 @by_handle.get
@@ -191,12 +623,104 @@ async def by_handle_delete(req):
 
     return json_response({})
 
+class UploadFileResponse(web.FileResponse):
+    """`FileResponse` of an uploaded file, prepared for the request `req`
+    instead of the one it answers.
+
+    `req` must only carry the ``Range`` that aiohttp has to send, the
+    conditional headers are evaluated by `uploads_get`. Depending on its
+    version, aiohttp also derives the content type and the entity tag of a
+    `FileResponse` from the file: the ones given in `fixed_headers` are
+    restored by `upload_response_prepare`.
+    """
+
+    def __init__(self, path, req, fixed_headers, **kwargs):
+        super().__init__(path, **kwargs)
+        self.fixed_headers = fixed_headers
+        self._req = req
+
+    async def prepare(self, request):
+        return await super().prepare(self._req)
+
+
+async def upload_response_prepare(req, resp):
+    """Signal handler of ``on_response_prepare``, see `UploadFileResponse`."""
+
+    if isinstance(resp, UploadFileResponse):
+        resp.headers.update(resp.fixed_headers)
+
+
+async def uploads_get(req):
+    """Request handler for ``GET /uploads/{name}``, the urls of the uploaded
+    files.
+
+    Uploaded files never change, they have a strong entity tag and can be
+    cached forever. Single byte ranges are supported. Files of the local
+    storage are sent with ``sendfile`` or, in production and if
+    ``uploads.offload`` is set, by the front proxy.
+    """
+
+    store = req.app['tozti-store']
+    name = req.match_info['name']
+    size, content_type, path = await store.upload_info(name)
+
+    etag = '"%s"' % name
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes',
+               'Cache-Control': 'public, max-age=31536000, immutable'}
+    if not_modified(req, etag):
+        return web.Response(status=304, headers=headers)
+    headers['Content-Type'] = content_type
+
+    config = tozti.CONFIG.get('store', {}).get('uploads', {})
+    offload = config.get('offload', '')
+    if path is not None and tozti.PRODUCTION and offload:
+        # the proxy sends the file and handles the ranges
+        if offload == 'x-accel-redirect':
+            headers['X-Accel-Redirect'] = '%s/%s' % (
+                config.get('accel_prefix', '/uploads-internal').rstrip('/'),
+                name)
+        elif offload == 'x-sendfile':
+            headers['X-Sendfile'] = os.path.abspath(path)
+        return web.Response(headers=headers)
+
+    try:
+        range = parse_range(req, size, etag)
+    except ValueError:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return web.Response(status=416, headers=headers)
+
+    if path is not None:
+        # conditions are already evaluated, only give the range to aiohttp
+        clean = {k: v for (k, v) in req.headers.items()
+                 if not k.lower().startswith('if-') and k.lower() != 'range'}
+        if range is not None:
+            clean['Range'] = 'bytes=%d-%d' % (range[0], range[1] - 1)
+        return UploadFileResponse(
+            path, req.clone(headers=clean),
+            {'ETag': etag, 'Content-Type': content_type}, headers=headers)
+
+    start, end = range if range is not None else (0, size)
+    resp = web.StreamResponse(status=200 if range is None else 206,
+                              headers=headers)
+    resp.content_length = end - start
+    if range is not None:
+        resp.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1,
+                                                           size)
+    await resp.prepare(req)
+    if req.method != 'HEAD':
+        async for chunk in await store.read_upload(name, start, end):
+            await resp.write(chunk)
+    return resp
+
+
 async def open_db(app, types):
     """Initialize storage backend at app startup."""
 
     from tozti.store.engine import Store
 
-    app['tozti-store'] = Store(types, **tozti.CONFIG['mongodb'])
+    app['tozti-store'] = Store(types, tozti.CONFIG.get('store'),
+                               **tozti.CONFIG['mongodb'])
+    await app['tozti-store'].start()
 
 
 async def close_db(app):
@@ -16,15 +16,18 @@
 # along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
 from uuid import UUID
 
 import jsonschema
+from pymongo import ASCENDING
 from jsonschema import validate, ValidationError
 
 import tozti
-from tozti.store import BadAttrError, BadItemError, BadRelError, NoItemError, NoResourceError
+from tozti.store import BadAttrError, BadItemError, BadRelError, NoItemError, BadQueryError
+from tozti.store.loader import run_concurrently
 from tozti.store.routes import UUID_RE
-from tozti.utils import validate, ValidationError, BadDataError
+from tozti.utils import validate, compile_validator, ValidationError, BadDataError, AsyncMap
 
 
 def fmt_resource_url(id):
@@ -37,6 +40,30 @@ def fmt_relationship_url(id, rel):
         tozti.CONFIG['http']['hostname'], id, rel)
 
 
+def coerce(value, schema):
+    """Convert a string given in a query to the JSON type of `schema`.
+
+    Other values are returned unchanged. Raises `ValueError` if the string
+    does not represent a value of that type.
+    """
+
+    if not isinstance(value, str):
+        return value
+    type = schema.get('type')
+    try:
+        if type == 'integer':
+            return int(value)
+        elif type == 'number':
+            return float(value)
+    except ValueError:
+        raise ValueError('%s is not of type %s' % (value, type))
+    if type == 'boolean':
+        if value not in ('true', 'false'):
+            raise ValueError('%s is not a boolean' % value)
+        return value == 'true'
+    return value
+
+
 class Schema:
     META_SCHEMA = {
         'type': 'object',
@@ -71,7 +98,7 @@ class Schema:
         'required': ['data'],
     }
 
-    def __init__(self, name, raw, *, db):
+    def __init__(self, name, raw, *, db, concurrency=8):
         try:
             validate(raw, Schema.META_SCHEMA)
         except ValidationError as err:
@@ -83,14 +110,18 @@ class Schema:
                 self._defs[key] = RelationshipModel(key, val_def, db=db)
             elif 'type' in val_def and val_def['type'] == 'upload':
                 self._defs[key] = UploadModel(
-                    key, val_def['acceptable'], db=db)
+                    key, val_def['acceptable'], db=db,
+                    max_size=val_def.get('max-size'))
             else:
                 self._defs[key] = AttributeModel(key, val_def, db=db)
 
         self._optional = raw.get('optional', [])
+        self._validate = compile_validator(Schema.SCHEMA)
 
         self.name = name
         self.db = db
+        # maximum number of body items queried at once by `render`
+        self.concurrency = concurrency
 
     async def sanitize(self, raw, *, is_create=True):
         """Verify the body posted for entity creation or update.
@@ -100,7 +131,7 @@ class Schema:
         """
 
         try:
-            validate(raw, Schema.SCHEMA)
+            self._validate(raw)
         except ValidationError as err:
             raise BadDataError(err.message)
 
@@ -116,33 +147,67 @@ class Schema:
         if is_create and len(sub2) > 0:
             raise BadItemError(key=sub2.pop(), msg='missing from body')
 
+        # the targets of the relationships are checked concurrently, so that
+        # the loader of the request looks them up with a single query
         body = {}
+        linked = []
         for (key, value) in data['body'].items():
-            body[key] = await self[key].sanitize(value)
+            if getattr(self[key], 'link_model', None) is not None:
+                linked.append((key, value))
+            else:
+                body[key] = await self[key].sanitize(value)
+        results = await run_concurrently(
+            self[key].sanitize(value) for (key, value) in linked)
+        for ((key, _), result) in zip(linked, results):
+            body[key] = result
 
         if is_create:
             return {'type': data['type'], 'body': body}
         else:
             return {'body.%s' % k: v for (k, v) in body.items()}
 
-    async def render(self, rep):
+    async def render(self, rep, fields=None):
         """Render a resource object given it's internal representation.
 
-        See https://jsonapi.org/format/#document-resource-objects.
+        If `fields` is given, only these body items are rendered. See
+        https://jsonapi.org/format/#document-resource-objects.
         """
 
         id = rep['_id']
+        # a projection on no body item leaves no body at all
+        items = rep.get('body', {})
 
         body = {}
+        queried = []
         for (key, schema) in self._defs.items():
-            body[key] = await schema.render(id, rep['body'].get(key))
+            if fields is not None and key not in fields:
+                continue
+            if schema.is_queried:
+                queried.append((key, schema))
+            else:
+                body[key] = await schema.render(id, items.get(key))
+
+        # items needing queries of their own are rendered concurrently, so
+        # that the resource takes as long as the slowest of them
+        if queried:
+            limit = asyncio.Semaphore(self.concurrency)
+
+            async def render_item(schema, data):
+                async with limit:
+                    return await schema.render(id, data)
+
+            results = await run_concurrently(
+                render_item(schema, items.get(key)) for (key, schema) in queried)
+            for ((key, _), result) in zip(queried, results):
+                body[key] = result
 
         return {'id': id,
                 'href': fmt_resource_url(id),
                 'type': rep['type'],
                 'body': body,
                 'meta': {'created': rep['created'],
-                         'last-modified': rep['last-modified']}}
+                         'last-modified': rep['last-modified'],
+                         'version': rep.get('version', 0)}}
 
     def __getitem__(self, key):
         if key not in self._defs:
@@ -152,6 +217,51 @@ class Schema:
     def __contains__(self, key):
         return key in self._defs
 
+    def items(self):
+        """Return the (key, model) pairs of the body items."""
+
+        return self._defs.items()
+
+    def is_stored(self, keys=None):
+        """Check if the body items `keys` (by default all of them) are
+        rendered from the stored document only."""
+
+        for (key, model) in self._defs.items():
+            if keys is not None and key not in keys:
+                continue
+            if model.is_queried:
+                return False
+        return True
+
+    def filter_query(self, filters):
+        """Compile filters into a MongoDB query on the resources of this type.
+
+        `filters` maps body items to dictionaries from operators to values,
+        eg ``{'age': {'gte': 18, 'lt': 65}}``. The supported operators are
+        documented in `AttributeModel.filter` and `RelationshipModel.filter`.
+        Raises `BadQueryError` if a filter is not supported.
+        """
+
+        query = {'type': self.name}
+        for (key, ops) in filters.items():
+            for (op, value) in ops.items():
+                param = 'filter[%s][%s]' % (key, op)
+                if key not in self._defs:
+                    raise BadQueryError(param=param,
+                                        msg='%s has no item %s' % (self.name, key))
+                try:
+                    (path, cond) = self._defs[key].filter(op, value)
+                except ValueError as err:
+                    raise BadQueryError(param=param, msg=str(err))
+                query.setdefault(path, {}).update(cond)
+        return query
+
+    def indexes(self):
+        """Yield the MongoDB indexes needed by this type, as lists of keys."""
+
+        for model in self._defs.values():
+            yield from model.indexes()
+
 
 class LinkageModel:
     def __init__(self, targets, *, db):
@@ -169,9 +279,25 @@ class LinkageModel:
         """
 
         target = UUID(linkage['id'])
-        try:
-            type_url = await self.db.type_by_id(target)
-        except NoResourceError:
+        types = await self.db.types_by_id([target], check=True)
+        return self._check(linkage, target, types.get(target))
+
+    async def sanitize_many(self, linkages):
+        """Verify that a sequence of linkages is valid.
+
+        Same as :meth:`sanitize` but every target is resolved with a single
+        query. Returns the list of internal linkages, in the same order.
+        """
+
+        targets = [UUID(linkage['id']) for linkage in linkages]
+        types = await self.db.types_by_id(targets, check=True)
+        return [self._check(linkage, target, types.get(target))
+                for (linkage, target) in zip(linkages, targets)]
+
+    def _check(self, linkage, target, type_url):
+        """Check a linkage given the real type of its target (if it exists)."""
+
+        if type_url is None:
             raise BadRelError('linked resource %s does not exist' % target)
         #FIXME: this error leaks type information, check if user can read
         # linked resource first
@@ -200,13 +326,15 @@ class LinkageModel:
 
 
 class UploadModel:
-    def __init__(self, name, acceptable, *, db):
+    def __init__(self, name, acceptable, *, db, max_size=None):
         self.acceptable = acceptable
+        self.max_size = max_size
         self.name = name
         self.db = db
         self.writeable = True
         self.is_upload = True
         self.is_array = False
+        self.is_queried = False
 
     async def sanitize(self, data):
         assert False, 'this should not be called'
@@ -214,15 +342,27 @@ class UploadModel:
     async def render(self, id, data):
         return data
 
+    def filter(self, op, value):
+        raise ValueError('cannot filter on upload %s' % self.name)
+
+    def indexes(self):
+        return ()
+
 
 
 class AttributeModel:
+    # filter operators and the corresponding MongoDB operators
+    FILTER_OPS = {'eq': '$eq', 'ne': '$ne', 'lt': '$lt', 'lte': '$lte',
+                  'gt': '$gt', 'gte': '$gte', 'in': '$in'}
+
     def __init__(self, name, schema, *, db):
         try:
             validate(schema, jsonschema.Draft4Validator.META_SCHEMA)
         except ValidationError as err:
             raise ValueError('invalid schema for %s: %s' % (name, err.message))
         self.schema = schema
+        self._validate = compile_validator(schema)
+        self.indexed = schema.get('index', False) is True
 
         self.name = name
         self.db = db
@@ -230,12 +370,13 @@ class AttributeModel:
         self.writeable = True
         self.is_upload = False
         self.is_array = 'type' in schema and schema['type'] == 'array'
+        self.is_queried = False
 
     async def sanitize(self, data, check_consistency=True):
         """Verify an attribute value and return it's content."""
 
         try:
-            validate(data, self.schema)
+            self._validate(data)
         except ValidationError as err:
             raise BadAttrError(key=self.name, err=err.message)
         return data
@@ -243,6 +384,37 @@ class AttributeModel:
     async def render(self, id, data):
         return data
 
+    def filter(self, op, value):
+        """Return the MongoDB condition of a filter, as a (path, condition)
+        pair.
+
+        The operators are those of `FILTER_OPS`, ``in`` taking a list (or a
+        comma-separated string). On arrays only ``contains`` is supported.
+        Values given as strings are converted to the type of the attribute.
+        Raises `ValueError` if the filter is not supported.
+        """
+
+        path = 'body.%s' % self.name
+        if self.is_array:
+            if op != 'contains':
+                raise ValueError('only contains is supported on arrays')
+            # an equality on an array matches its elements
+            return path, {'$eq': coerce(value, self.schema.get('items', {}))}
+
+        if op not in self.FILTER_OPS:
+            raise ValueError('unknown operator %s' % op)
+        if op == 'in':
+            if isinstance(value, str):
+                value = value.split(',')
+            value = [coerce(v, self.schema) for v in value]
+        else:
+            value = coerce(value, self.schema)
+        return path, {self.FILTER_OPS[op]: value}
+
+    def indexes(self):
+        if self.indexed:
+            yield [('type', ASCENDING), ('body.%s' % self.name, ASCENDING)]
+
 
 class RelationshipModel:
     META_SCHEMA = {
@@ -310,11 +482,21 @@ class RelationshipModel:
         except ValidationError:
             raise ValueError('invalid schema for relationship %s' % name)
         self.arity = schema['arity']
+        if self.arity == 'to-one':
+            self._validate = compile_validator(RelationshipModel.TO_ONE_SCHEMA)
+        elif self.arity == 'to-many':
+            self._validate = compile_validator(RelationshipModel.TO_MANY_SCHEMA)
         if self.arity in ('to-one', 'to-many'):
             self.link_model = LinkageModel(schema.get('targets'), db=db)
         else:  # self.arity == 'auto'
             self.pred_type = schema['pred-type']
+            if isinstance(self.pred_type, str):
+                self.pred_types = [self.pred_type]
+            else:
+                self.pred_types = self.pred_type
             self.pred_rel = schema['pred-relationship']
+            # set by the store when the inverse edges are kept on the target
+            self.materialized = False
 
         self.name = name
         self.db = db
@@ -323,12 +505,18 @@ class RelationshipModel:
         self.is_upload = False
         self.is_array = self.arity == 'to-many'
 
+    @property
+    def is_queried(self):
+        """Whether rendering the relationship needs a query of its own."""
+
+        return self.arity == 'auto' and not self.materialized
+
     async def sanitize(self, data, check_consistency=True):
         """Verify the relationship object and return its internal format."""
 
         if self.arity == 'to-one':
             try:
-                validate(data, RelationshipModel.TO_ONE_SCHEMA)
+                self._validate(data)
             except ValidationError as err:
                 raise BadRelError(key=self.name, err=err.message)
             if check_consistency:
@@ -338,14 +526,11 @@ class RelationshipModel:
 
         elif self.arity == 'to-many':
             try:
-                validate(data, RelationshipModel.TO_MANY_SCHEMA)
+                self._validate(data)
             except ValidationError as err:
                 raise BadRelError(key=self.name, err=err.message)
             if check_consistency:
-                links = []
-                for link in data['data']:
-                    links.append(await self.link_model.sanitize(link))
-                return links
+                return await self.link_model.sanitize_many(data['data'])
             else:
                 return [{'id': link['id']} for link in data['data']]
 
@@ -368,16 +553,54 @@ class RelationshipModel:
         elif self.arity == 'to-many':
             data = [self.link_model.render(l) for l in link]
 
+        elif self.materialized:
+            data = [{'id': l['id'],
+                     'type': l['type'],
+                     'href': fmt_resource_url(l['id'])} for l in link or ()]
+
         else:  # self.arity == 'auto'
-            cursor = self.db._db.resources.find(
-                {'type': self.pred_type,
-                 'body.%s.id' % self.pred_rel: id},
-                {'_id': 1, 'type': 1})
             data = []
-            async for hit in cursor:
-                data.append({'id': hit['_id'],
-                             'type': hit['type'],
-                             'href': fmt_resource_url(hit['_id'])})
+            async for link in self.targets(id):
+                data.append(link)
 
         return {'self': fmt_relationship_url(id, self.name),
                 'data': data}
+
+    def targets(self, id):
+        """Return an asynchronous iterator over the linkages of a non
+        materialized `auto` relationship of resource `id`."""
+
+        cursor = self.db._db.resources.find(
+            {'type': {'$in': self.pred_types},
+             'body.%s.id' % self.pred_rel: id},
+            {'_id': 1, 'type': 1})
+        return AsyncMap(cursor, lambda hit: {'id': hit['_id'],
+                                             'type': hit['type'],
+                                             'href': fmt_resource_url(hit['_id'])})
+
+    def filter(self, op, value):
+        """Return the MongoDB condition of a filter, as a (path, condition)
+        pair.
+
+        The only operator is ``contains``: the relationship targets the
+        resource with id `value`. `auto` relationships must be materialized.
+        Raises `ValueError` if the filter is not supported.
+        """
+
+        if op != 'contains':
+            raise ValueError('only contains is supported on relationships')
+        if self.arity == 'auto' and not self.materialized:
+            raise ValueError('%s is not materialized' % self.name)
+        try:
+            id = value if isinstance(value, UUID) else UUID(value)
+        except ValueError:
+            raise ValueError('%s is not an id' % value)
+        return 'body.%s.id' % self.name, {'$eq': id}
+
+    def indexes(self):
+        if self.arity == 'auto' and not self.materialized:
+            # used by the query in `render`
+            yield [('type', ASCENDING), ('body.%s.id' % self.pred_rel, ASCENDING)]
+        elif self.arity != 'auto':
+            # used by the filters and to collect the dangling linkages
+            yield [('type', ASCENDING), ('body.%s.id' % self.name, ASCENDING)]
@@ -0,0 +1,127 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of Tozti.
+
+# Tozti is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Tozti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Tozti.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Helpers on the streams of uploaded files."""
+
+
+import asyncio
+import re
+
+from tozti.store import UploadTooLargeError
+
+
+# uploaded files are named after the SHA-256 of their content
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def upload_digest(url):
+    """Return the digest of the file at an upload url, or `None` if `url` is
+    not one (e.g. files uploaded before they were content-addressed)."""
+
+    if not isinstance(url, str):
+        return None
+    digest = url.rsplit('/', 1)[-1]
+    return digest if DIGEST_RE.match(digest) else None
+
+
+async def copy_stream(stream, write, max_size=None, chunk_size=65536):
+    """Read a `StreamReader` and give its chunks to the coroutine function
+    `write`. Return the number of bytes read.
+
+    The next chunk is read from the network while the previous one is
+    written, so at most two chunks of `chunk_size` bytes are in memory
+    whatever the speed of the storage. Raise `UploadTooLargeError` as soon
+    as more than `max_size` bytes are read.
+    """
+
+    size = 0
+    pending = None
+    try:
+        while True:
+            chunk = await stream.read(chunk_size)
+            if pending is not None:
+                await pending
+                pending = None
+            if not chunk:
+                return size
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise UploadTooLargeError(max_size=max_size)
+            pending = asyncio.ensure_future(write(chunk))
+    except BaseException:
+        # the caller must not close the file while a chunk is being written
+        if pending is not None:
+            await asyncio.wait([pending])
+        raise
+
+
+class ChunkStream:
+    """Part of a resumable upload read from a `StreamReader`.
+
+    Reading stops after `limit` bytes. Errors (e.g. a lost connection) end
+    the stream instead of being raised, so that the data received so far
+    can be kept: they are stored in :attr:`error`, as well as
+    `UploadTooLargeError` if there was more than `limit` bytes to read.
+    """
+
+    def __init__(self, stream, limit):
+        self.error = None
+        self._stream = stream
+        self._left = limit
+
+    async def read(self, n):
+        if self.error is not None:
+            return b''
+        try:
+            chunk = await self._stream.read(min(n, self._left) or 1)
+        except Exception as err:
+            self.error = err
+            return b''
+        if len(chunk) > self._left:
+            self.error = UploadTooLargeError(max_size=self._left)
+            return b''
+        self._left -= len(chunk)
+        return chunk
+
+    def abort(self, error):
+        """End the stream before its next chunk, with given error."""
+
+        if self.error is None:
+            self.error = error
+
+
+class ConcatStream:
+    """Concatenation of blobs of a `BlobStorage`, with the interface of a
+    `StreamReader`."""
+
+    def __init__(self, storage, names):
+        self._storage = storage
+        self._names = list(names)
+        self._reader = None
+
+    async def read(self, n):
+        while True:
+            if self._reader is None:
+                if not self._names:
+                    return b''
+                self._reader = await self._storage.read(self._names.pop(0))
+            try:
+                return await self._reader.__anext__()
+            except StopAsyncIteration:
+                self._reader = None
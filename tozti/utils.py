@@ -17,10 +17,11 @@
 
 
 from json import JSONEncoder, dumps
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from uuid import UUID
 
-from aiohttp.web import json_response as _json_response
+from aiohttp.web import StreamResponse, json_response as _json_response
 import jsonschema
 from jsonschema.exceptions import ValidationError
 
@@ -163,11 +164,214 @@ def json_response(data, **kwargs):
     return _json_response(data, dumps=fancy_dumps, **kwargs)
 
 
+def http_date(date):
+    """Format a naive UTC `datetime.datetime` as an HTTP date (RFC 7231)."""
+
+    return format_datetime(date.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+def parse_http_date(value):
+    """Parse an HTTP date into a naive UTC `datetime.datetime`.
+
+    Returns `None` if `value` is not a valid date.
+    """
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def etag_matches(header, etag, weak=True):
+    """Check if the entity tag `etag` is listed in an ``If-Match`` or
+    ``If-None-Match`` header value (RFC 7232).
+
+    With `weak` comparison, the weakness indicators are ignored. Otherwise
+    weak tags never match.
+    """
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def not_modified(req, etag=None, last_modified=None):
+    """Evaluate the ``If-None-Match`` and ``If-Modified-Since`` headers of a
+    ``GET`` or ``HEAD`` request (RFC 7232).
+
+    Returns true if the client's copy, described by the validators `etag` and
+    `last_modified` (a naive UTC datetime), is still fresh and a ``304`` can
+    be sent.
+    """
+
+    if 'If-None-Match' in req.headers:
+        return etag is not None and etag_matches(req.headers['If-None-Match'], etag)
+    if 'If-Modified-Since' in req.headers and last_modified is not None:
+        since = parse_http_date(req.headers['If-Modified-Since'])
+        # HTTP dates have a precision of one second
+        return since is not None and last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def parse_range(req, size, etag=None):
+    """Return the byte range requested by the ``Range`` header of a ``GET``
+    request on a representation of `size` bytes (RFC 7233), as a pair
+    ``(start, end)`` with `end` excluded.
+
+    Returns `None` if the whole representation must be sent: there is no
+    such header, it is not a single valid byte range or the ``If-Range``
+    header does not match the strong entity tag `etag`. Raises `ValueError`
+    if the range cannot be satisfied.
+    """
+
+    header = req.headers.get('Range')
+    if header is None:
+        return None
+    if_range = req.headers.get('If-Range')
+    if if_range is not None and (etag is None or if_range.strip() != etag):
+        return None
+
+    unit, _, spec = header.partition('=')
+    first, sep, last = spec.strip().partition('-')
+    first, last = first.strip(), last.strip()
+    if (unit.strip() != 'bytes' or not sep or not (first or last)
+            or not all(x.isdigit() for x in (first, last) if x)):
+        return None
+
+    if not first:
+        # the last bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('unsatisfiable range %s' % header)
+        return max(size - length, 0), size
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if last and end <= start:
+        return None
+    if start >= size:
+        raise ValueError('unsatisfiable range %s' % header)
+    return start, min(end, size)
+
+
+_FORMAT_CHECKER = jsonschema.FormatChecker()
+
+
+class AsyncMap:
+    """Asynchronous iterator applying `func` to the elements of an
+    asynchronous iterable (eg a Motor cursor)."""
+
+    def __init__(self, iterable, func):
+        self._iterator = iterable.__aiter__()
+        self._func = func
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return self._func(await self._iterator.__anext__())
+
+
+async def stream_json_response(req, items, path=('data',), meta=None,
+                               buffer_size=65536, **kwargs):
+    """Send a JSON response containing an array produced incrementally.
+
+    The elements of the asynchronous iterable `items` are encoded as they
+    come and sent with chunked transfer encoding, at most `buffer_size` bytes
+    are buffered. The array is nested in objects along the keys `path`, the
+    innermost object can contain other entries: they are given by `meta`, a
+    function called once `items` is exhausted that returns a dictionary.
+
+    For example with ``path=('data', 'data')`` and ``meta=lambda: {'a': 1}``
+    the response is ``{"data": {"data": [...], "a": 1}}``.
+
+    The first element is read before the status is sent, so that errors
+    such as an invalid query are still answered as usual. Once the response
+    is started, an error aborts the connection: the client sees a truncated
+    response instead of a complete one.
+    """
+
+    iterator = items.__aiter__()
+    pending = []
+    try:
+        pending.append(await iterator.__anext__())
+    except StopAsyncIteration:
+        iterator = None
+
+    resp = StreamResponse(**kwargs)
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(req)
+
+    try:
+        buf = [''.join('{%s: ' % dumps(key) for key in path), '[']
+        size = 0
+        first = True
+        while pending:
+            if not first:
+                buf.append(', ')
+            first = False
+            chunk = dumps(pending.pop(), cls=ExtendedJSONEncoder)
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                await resp.write(''.join(buf).encode('utf-8'))
+                buf = []
+                size = 0
+            if iterator is not None:
+                try:
+                    pending.append(await iterator.__anext__())
+                except StopAsyncIteration:
+                    iterator = None
+
+        buf.append(']')
+        if meta is not None:
+            for (key, value) in meta().items():
+                buf.append(', %s: %s' % (dumps(key),
+                                         dumps(value, cls=ExtendedJSONEncoder)))
+        buf.append('}' * len(path))
+        await resp.write(''.join(buf).encode('utf-8'))
+    except BaseException:
+        if req.transport is not None:
+            req.transport.close()
+        raise
+    await resp.write_eof()
+    return resp
+
+
 def validate(inst, schema):
     """Validate data against a JsonSchema."""
 
     return jsonschema.validate(inst, schema, cls=jsonschema.Draft4Validator,
-                               format_checker=jsonschema.FormatChecker())
+                               format_checker=_FORMAT_CHECKER)
+
+
+def compile_validator(schema):
+    """Compile a JsonSchema into a validation function.
+
+    The schema is checked and the validator is built only once, so that the
+    returned callable can be used on the hot path. It behaves exactly like
+    :func:`validate` with a fixed schema: it raises `ValidationError` (with
+    the same messages) if the data is invalid.
+    """
+
+    jsonschema.Draft4Validator.check_schema(schema)
+    validator = jsonschema.Draft4Validator(schema,
+                                           format_checker=_FORMAT_CHECKER)
+    return validator.validate
 
 
 class ConfigError(Exception):
@@ -193,15 +397,19 @@ class APIError(Exception):
 
         super().__init__(*args)
 
-    def to_response(self):
-        """Create an `aiohttp.web.Response` signifiying the error."""
+    def to_dict(self):
+        """Return the JSON API error object signifiying the error."""
 
         error = {'code': self.code, 'title': self.title,
                  'status': str(self.status)}
         if len(self.args) > 0:
             error['detail'] = self.args[0]
+        return error
+
+    def to_response(self):
+        """Create an `aiohttp.web.Response` signifiying the error."""
 
-        return json_response({'errors': [error]}, status=self.status)
+        return json_response({'errors': [self.to_dict()]}, status=self.status)
 
 
 class NotJsonError(APIError):